@@ -1,64 +1,485 @@
 import pandas as pd
-import sys, os
-import re
+import numpy as np
+import os
+import glob
+import argparse
+import pickle
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
-in_content = {}
+try:
+  import pyarrow
+except ImportError:
+  pyarrow = None
 
-# read mapped values of StudyDescription/Modality combinations
-out_df = pd.read_csv(os.path.join(sys.argv[1], "out", "StudyDescription_mapping_table.csv"))
+from mapping_index import KEY_COLUMNS, load_mapping_index, mapping_table_path, attributes_path
+from normalization import NORMALIZATION_VERSION
+from modality import canonicalize_modalities
+from suggest import SuggestionIndex, suggest_for
+from manifest import file_digest, read_manifest, write_manifest, new_manifest, is_up_to_date, plan_rediff
+from instrumentation import recorder, stage
+from automap import load_rules, rules_path
+from harmonization_db import HarmonizationDatabase, database_path
+from coverage import Coverage, coverage_report, row_weights, write_report
 
-# remove spaces in Modality column
-out_df["Modality"] = out_df["Modality"].str.replace(" ", "")
+# raw spellings kept per normalized key in pending/StudyDescription_diffs.csv
+MAX_VARIANTS = 3
 
-# split Modality column into array by comma 
-out_df["Modality"] = out_df["Modality"].str.split(",")
+# key columns are read as categoricals, so each distinct string is held once instead of once per row
+INPUT_DTYPES = {"Modality": "category", "StudyDescription": "category"}
 
-# explode Modality column into multiple rows
-out_df = out_df.explode("Modality")
+# find the per-site StudyDescription files in in/, named
+# <DICOM attribute name>_<data collection site>.csv (or .tsv)
+def discover_inputs(root):
+  fileNames = glob.glob(os.path.join(root, "in", "*.csv")) + glob.glob(os.path.join(root, "in", "*.tsv"))
+  return sorted(f for f in fileNames if os.path.basename(f).startswith("StudyDescription"))
 
-print(out_df)
+def contributor_from_filename(fileName):
+  base = os.path.splitext(os.path.basename(fileName))[0]
+  attribute, sep, site = base.partition("_")
+  return site if sep and site else base
 
-all_diffs = None
+def input_separator(fileName):
+  return "\t" if fileName.endswith(".tsv") else ","
 
-pattern = r"^\s+|\s+$|\s+(?=\s)"
+# normalize the keys and code them as int32 against the vocabularies of the mapping index; every
+# distinct raw value is normalized and interned once
+def normalize_input(in_df, index):
+  with stage("normalize", len(in_df)) as s:
+    # keep the observed spelling for the reviewers
+    in_df["RawStudyDescription"] = in_df["StudyDescription"]
 
-   
-fileName = os.path.join(sys.argv[1], "in", f"StudyDescriptions_Gen3.tsv")
+    in_df["StudyDescription"] = index.descriptionVocabulary.encode(in_df["StudyDescription"], index.normalize_descriptions)
+    in_df["Modality"] = index.modalityVocabulary.encode(in_df["Modality"], canonicalize_modalities)
+    s.rowsOut = len(in_df)
 
-if os.path.exists(fileName):
-  
-  print(f"Loading ...")
-  in_df = pd.read_csv(fileName, sep="\t")
+  return in_df
 
-  # clean up spaces
-  in_df["StudyDescription"] = in_df["StudyDescription"].str.replace(pattern, " ")
-  out_df["StudyDescription"] = out_df["StudyDescription"].str.replace(pattern, " ")
+# key codes back to the normalized strings, for the rows that leave diff_input
+def decode_keys(diff_df, index):
+  return diff_df.assign(StudyDescription=index.descriptionVocabulary.decode(diff_df["StudyDescription"]),
+                        Modality=index.modalityVocabulary.decode(diff_df["Modality"]))
 
-  # capitalize
-  in_df['StudyDescription'] = in_df['StudyDescription'].str.upper()
-  out_df['StudyDescription'] = out_df['StudyDescription'].str.upper()
+# one tuple per group of at most MAX_VARIANTS distinct spellings, in order of appearance; groupIds
+# and spellings (codes into values, -1 when missing) are parallel arrays
+def collect_variants(groupIds, spellings, values, groups):
+  present = spellings >= 0
+  groupIds, spellings = groupIds[present], spellings[present]
+  first = ~pd.Series(groupIds.astype(np.int64) * (len(values) + 1) + spellings).duplicated().to_numpy()
+  groupIds, spellings = groupIds[first], spellings[first]
+  kept = pd.Series(groupIds).groupby(groupIds).cumcount().to_numpy() < MAX_VARIANTS
+  groupIds, spellings = groupIds[kept], spellings[kept]
 
-  diff_df = pd.merge(in_df, out_df, on=["StudyDescription", "Modality"], how="outer", indicator=True)
-  diff_df = diff_df[diff_df["_merge"] == "left_only"]
+  # slices of the spellings sorted by group
+  order = np.argsort(groupIds, kind="stable")
+  spellings = np.asarray(values, dtype=object)[spellings[order]]
+  bounds = np.searchsorted(groupIds[order], np.arange(groups + 1))
+  return [tuple(spellings[bounds[i]:bounds[i + 1]]) for i in range(groups)]
 
-  #print("Merge result")
-  #print(diff_df)
-  diff_df["Contributor"] = "Gen3"
+# collapse rows that normalize to the same (StudyDescription, Modality) key: frequencies are
+# summed (input rows are counted in `rows` when there is no frequency column, for the coverage
+# weights) and a bounded sample of the raw spellings is kept, indexed by the key columns
+def aggregate_input(in_df):
+  with stage("aggregate", len(in_df)) as s:
+    aggregate = _aggregate_input(in_df)
+    s.rowsOut = len(aggregate)
+  return aggregate
 
-  print(diff_df)
+def _aggregate_input(in_df):
+  # the int32 key codes (-1 when missing) are folded into one int64 per (StudyDescription, Modality)
+  # pair, and groups are numbered in order of first appearance
+  pairKeys = (((in_df["StudyDescription"].to_numpy().astype(np.int64) + 1) << 32) |
+              (in_df["Modality"].to_numpy().astype(np.int64) + 1))
+  groupIds, pairs = pd.factorize(pairKeys)
+  keys = pd.MultiIndex.from_arrays([((pairs >> 32) - 1).astype(np.int32), ((pairs & 0xFFFFFFFF) - 1).astype(np.int32)],
+                                   names=KEY_COLUMNS)
 
-  if not "frequency" in diff_df.columns:
-    diff_df["frequency"] = "N/A"
+  aggregate = pd.DataFrame(index=keys)
+  if "frequency" in in_df.columns:
+    aggregate["frequency"] = in_df["frequency"].groupby(groupIds).sum().to_numpy()
+  else:
+    aggregate["rows"] = np.bincount(groupIds, minlength=len(pairs))
+
+  rawCodes, rawValues = pd.factorize(in_df["RawStudyDescription"])
+  aggregate["Variants"] = pd.Series(collect_variants(groupIds, rawCodes, rawValues, len(pairs)), index=keys, dtype=object)
+  return aggregate
+
+# read, normalize and aggregate one contributor file, with coded keys
+def load_input(fileName, index):
+  with stage("read input") as s:
+    in_df = pd.read_csv(fileName, sep=input_separator(fileName), dtype=INPUT_DTYPES)
+    s.rowsOut = len(in_df)
+
+  return aggregate_input(normalize_input(in_df, index)).reset_index()
+
+# fold the aggregated unmapped rows of one chunk into the running aggregate of distinct unmapped keys;
+# only keys seen in both are regrouped
+def fold_unmapped(aggregate, partial):
+  if aggregate is None:
+    return partial
+
+  combined = pd.concat([aggregate, partial])
+  repeated = combined.index.duplicated(keep=False)
+  if not repeated.any():
+    return combined
 
-  if all_diffs is None:
-    all_diffs = diff_df[["StudyDescription", "Modality", "frequency", "Contributor"]]
+  rows = combined[repeated]
+  groupIds, keys = rows.index.factorize()
+  merged = pd.DataFrame(index=keys.set_names(KEY_COLUMNS))
+  if "frequency" in combined.columns:
+    merged["frequency"] = rows["frequency"].groupby(groupIds).sum().to_numpy()
   else:
-    all_diffs = pd.concat([all_diffs, diff_df[['StudyDescription', 'Modality','frequency', 'Contributor']]])
+    merged["rows"] = rows["rows"].groupby(groupIds).sum().to_numpy()
+
+  # the variants of the repeated rows, flattened with the group of their row
+  lengths = rows["Variants"].map(len).to_numpy()
+  spellings, values = pd.factorize(pd.Series([v for variants in rows["Variants"] for v in variants], dtype=object))
+  merged["Variants"] = pd.Series(collect_variants(np.repeat(groupIds, lengths), spellings, values, len(keys)),
+                                 index=merged.index, dtype=object)
+  return pd.concat([combined[~repeated], merged[combined.columns]])
+
+# read one contributor file in chunks and keep only the aggregated unmapped rows, so memory is
+# bounded by the number of distinct unmapped keys; the aggregated rows of every chunk are also
+# pickled to spool, when given, one frame per chunk; runs in a worker process
+def stream_input(fileName, index, chunksize, coverage=None, spool=None):
+  aggregate = None
+  with pd.read_csv(fileName, sep=input_separator(fileName), dtype=INPUT_DTYPES, chunksize=chunksize) as reader:
+    while True:
+      with stage("read input") as s:
+        chunk = next(reader, None)
+        s.rowsOut = len(chunk) if chunk is not None else 0
+      if chunk is None:
+        break
+      partial = aggregate_input(normalize_input(chunk, index))
+      if spool is not None:
+        pickle.dump(decode_keys(partial.reset_index(), index), spool, protocol=pickle.HIGHEST_PROTOCOL)
+      partial = unmapped_rows(partial, index, partial.index.to_frame(index=False), coded=True, coverage=coverage)
+      with stage("fold", len(partial)) as s:
+        aggregate = fold_unmapped(aggregate, partial)
+        s.rowsOut = len(aggregate)
+
+  return aggregate.reset_index() if aggregate is not None else pd.DataFrame(columns=KEY_COLUMNS + ["Variants"])
+
+# anti-join: rows of df whose key (the rows of keys, df itself by default) is not in the mapping table;
+# coded keys are looked up by their vocabulary codes; the weights of the mapped and unmapped rows
+# are added to coverage on the way (see Coverage.add for recount)
+def unmapped_rows(df, index, keys=None, coded=False, coverage=None, recount=False):
+  keys = df if keys is None else keys
+  with stage("merge", len(df)) as s:
+    if coded:
+      positions = index.locate_codes(keys["StudyDescription"].to_numpy(), keys["Modality"].to_numpy())
+    else:
+      positions = index.locate(keys)
+    mapped = positions >= 0
+    if coverage is not None:
+      coverage.add(index.rows, keys["Modality"], positions, row_weights(df),
+                   index.modalityVocabulary.decode if coded else None, recount)
+    s.rowsOut = len(df)
+  with stage("filter", len(df)) as s:
+    df = df[~mapped]
+    s.rowsOut = len(df)
+  return df
+
+# (unmapped rows, observed rows or None, coverage) of one contributor file; when observe is set the
+# observed rows are all aggregated rows, or with chunksize the name of a temporary file they are
+# spooled to chunk by chunk (see read_observed); runs in a worker process, so the keys are decoded
+# before they leave it
+def diff_input(fileName, index, chunksize=None, observe=False):
+  coverage = Coverage()
+  if chunksize:
+    spool = tempfile.NamedTemporaryFile(prefix="observed-", suffix=".pickle", delete=False) if observe else None
+    try:
+      diff_df = stream_input(fileName, index, chunksize, coverage, spool)
+    finally:
+      if spool is not None:
+        spool.close()
+    return decode_keys(diff_df, index), spool.name if observe else None, coverage
+
+  observed = load_input(fileName, index)
+  diff_df = unmapped_rows(observed, index, coded=True, coverage=coverage)
+  return decode_keys(diff_df, index), decode_keys(observed, index) if observe else None, coverage
+
+# frames of the observed rows returned by diff_input; a spool file is read one chunk at a time and
+# deleted once read
+def read_observed(observed):
+  if isinstance(observed, pd.DataFrame):
+    yield observed
+    return
+  try:
+    with open(observed, "rb") as f:
+      while True:
+        try:
+          yield pickle.load(f)
+        except EOFError:
+          break
+  finally:
+    os.unlink(observed)
+
+# diff_input in a worker process, returning the stages it recorded along with the result
+def diff_input_recorded(fileName, index, chunksize=None, observe=False):
+  recorder.drain()
+  result = diff_input(fileName, index, chunksize, observe)
+  return result, recorder.drain()
+
+def diff_inputs(fileNames, index, chunksize=None, jobs=None, observe=False):
+  if len(fileNames) < 2 or jobs == 1:
+    return [diff_input(f, index, chunksize, observe) for f in fileNames]
+  count = len(fileNames)
+  with ProcessPoolExecutor(max_workers=jobs) as pool:
+    results = list(pool.map(diff_input_recorded, fileNames, [index] * count, [chunksize] * count, [observe] * count))
+  for _, stages in results:
+    recorder.merge(stages)
+  return [result for result, _ in results]
+
+def label_diff(diff_df, contributor):
+  diff_df["Contributor"] = contributor
+
+  # files without a frequency column are reported as "N/A" once all contributors are sorted
+  if not "frequency" in diff_df.columns:
+    diff_df["frequency"] = pd.Series(pd.NA, index=diff_df.index, dtype="Int64")
+
+  diff_df["Variants"] = diff_df["Variants"].map(" | ".join)
+
+  return diff_df[["StudyDescription", "Modality", "frequency", "Contributor", "Variants"]]
+
+# (the `top` rows of diff_df by frequency, sorted, the other rows in their original order); the head
+# is selected with a linear-time partition, so only `top` rows are sorted
+def top_rows(diff_df, top):
+  frequencies = pd.to_numeric(diff_df["frequency"], errors="coerce").fillna(-1).to_numpy(dtype=np.float64)
+  inHead = np.zeros(len(diff_df), dtype=bool)
+  inHead[np.argpartition(-frequencies, top - 1)[:top]] = True
+  head = diff_df[inHead].sort_values(by=["frequency"], ascending=False)
+  return head, diff_df[~inHead]
+
+# the unmapped rows of each input file are kept in the manifest as JSON columns
+def diff_to_columns(diff_df):
+  columns = {c: diff_df[c].tolist() for c in diff_df.columns}
+  columns["Variants"] = [list(v) for v in diff_df["Variants"]]
+  return columns
+
+def diff_from_columns(columns):
+  diff_df = pd.DataFrame(columns)
+  diff_df["Variants"] = diff_df["Variants"].map(tuple)
+  return diff_df
+
+# typed Parquet copy of a frame for downstream tools: string columns listed in categoricals become
+# dictionary-encoded categoricals, frequency a (nullable) int64
+def write_parquet(df, fileName, categoricals):
+  df = df.copy()
+  for column in categoricals:
+    df[column] = df[column].astype("category")
+  if "frequency" in df.columns:
+    df["frequency"] = pd.to_numeric(df["frequency"], errors="coerce").astype("Int64")
+  df.to_parquet(fileName, engine="pyarrow", index=False)
+
+def positive_int(text):
+  value = int(text)
+  if value < 1:
+    raise argparse.ArgumentTypeError(f"{text} is not a positive number")
+  return value
+
+def relative_name(root, fileName):
+  return os.path.relpath(fileName, root).replace(os.sep, "/")
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Update the list of unmapped StudyDescription values")
+  parser.add_argument("root", help="repository root containing in/, out/ and pending/")
+  parser.add_argument("--jobs", type=int, default=None, help="worker processes used to load the input files")
+  parser.add_argument("--chunksize", type=int, default=None,
+                      help="stream each input file in chunks of this many rows instead of loading it whole")
+  parser.add_argument("--cache-dir", default=None,
+                      help="directory of compiled mapping indexes (default: <root>/.cache)")
+  parser.add_argument("--suggestions", type=int, default=3,
+                      help="closest mapped descriptions suggested per unmapped value, 0 to skip")
+  parser.add_argument("--no-parquet", dest="parquet", action="store_false",
+                      help="do not write the Parquet copies of the diff and of the exploded mapping table")
+  parser.add_argument("--no-rules", dest="rules", action="store_false",
+                      help="do not auto-map unmapped rows with the rules of out/StudyDescription_rules.csv")
+  parser.add_argument("--top", type=positive_int, default=None,
+                      help="sort only the N most frequent unmapped rows into pending/StudyDescription_diffs.csv and "
+                           "write the others unsorted to pending/StudyDescription_diffs_tail.csv")
+  parser.add_argument("--coverage-top", type=positive_int, default=20,
+                      help="heaviest unmapped values listed in pending/StudyDescription_coverage.json")
+  parser.add_argument("--database", action="store_true",
+                      help="keep the harmonization database (<cache-dir>/harmonization.sqlite) up to date")
+  parser.add_argument("-v", "--verbose", action="store_true",
+                      help="print the mapping table and the unmapped rows of every file")
+  parser.add_argument("--metrics", default=None,
+                      help="JSON file of the wall time, CPU time, peak RSS and row counts of every stage")
+  parser.add_argument("--openmetrics", default=None, help="the same stage metrics in OpenMetrics text format")
+  args = parser.parse_args(argv)
+
+  if args.parquet and pyarrow is None:
+    print("pyarrow is not installed, skipping the Parquet outputs")
+    args.parquet = False
+
+  rules = {"normalization": NORMALIZATION_VERSION}
+
+  fileNames = discover_inputs(args.root)
+  inputDigests = {relative_name(args.root, f): file_digest(f) for f in fileNames}
+  mappingDigest = file_digest(mapping_table_path(args.root))
+  # auto-mapping runs on the unmapped rows of every run, so changed rules need no re-diff
+  automapDigest = file_digest(rules_path(args.root)) if args.rules and os.path.exists(rules_path(args.root)) else None
+  # options that shape the files of pending/, which are rewritten when they change even if no input did
+  outputs = {"top": args.top, "suggestions": args.suggestions, "coverage_top": args.coverage_top, "parquet": args.parquet}
+
+  # the database records the observations of every input file, so files it has no current
+  # observations of are read again even when the manifest has their unmapped rows
+  database = None
+  sourceDigests = {}
+  if args.database:
+    database = HarmonizationDatabase(database_path(args.cache_dir or os.path.join(args.root, ".cache")))
+    sourceDigests = {relative_name(args.root, f): file_digest(f) for f in (mapping_table_path(args.root), attributes_path(args.root))}
+    unobserved = set(database.stale_inputs(inputDigests))
+    if database.removed_inputs(inputDigests) or not database.is_current(sourceDigests):
+      unobserved.add(None)
+
+  # nothing to do when neither the mapping table, the rules, the output options nor any input file
+  # changed since the last run
+  manifest = read_manifest(args.root, rules)
+  if (is_up_to_date(manifest, mappingDigest, inputDigests) and manifest.get("automap") == automapDigest and
+      manifest.get("outputs") == outputs and (database is None or not unobserved)):
+    print("Mapping table, rules, output options and input files are unchanged, nothing to diff")
+    if database is not None:
+      database.close()
+    return
+
+  # the mapping table is loaded, normalized and indexed once (or read back from the cache), then
+  # shared by all contributors
+  index = load_mapping_index(args.root, args.cache_dir, mappingDigest)
+
+  if args.verbose:
+    print(index.rows)
+
+  if args.parquet:
+    with stage("write", len(index.rows)) as s:
+      write_parquet(index.rows, os.path.join(args.root, "out", "StudyDescription_mapping_table.parquet"),
+                    ["Modality", "LOINC code", "L-Long Common Name"])
+      s.rowsOut = len(index.rows)
+
+  plan = plan_rediff(manifest, mappingDigest, index.keys, inputDigests, index.exactSpellings)
+  if database is not None:
+    plan.update({name: "diff" for name in unobserved if name is not None})
+  updated = new_manifest(rules, mappingDigest, index.keys, index.exactSpellings)
+  updated["automap"] = automapDigest
+  updated["outputs"] = outputs
+
+  toDiff = [f for f in fileNames if plan[relative_name(args.root, f)] == "diff"]
+  print(f"Loading {len(toDiff)} of {len(fileNames)} file(s) ...")
+  fresh = dict(zip(toDiff, diff_inputs(toDiff, index, args.chunksize, args.jobs, observe=database is not None)))
+
+  diffs = []
+  coverages = []
+  # unmapped keys with their coverage weight, which label_diff does not keep for files without frequency
+  weighted = []
+  for fileName in fileNames:
+    name = relative_name(args.root, fileName)
+    if plan[name] == "diff":
+      diff_df, observed, coverage = fresh[fileName]
+    else:
+      diff_df = diff_from_columns(manifest["inputs"][name]["unmapped"])
+      coverage = Coverage.from_columns(manifest["inputs"][name]["coverage"])
+      if plan[name] == "recheck":
+        # the cached rows are already in the totals, only those mapped now are added
+        diff_df = unmapped_rows(diff_df, index, coverage=coverage, recount=True)
+
+    contributor = contributor_from_filename(fileName)
+    if database is not None and plan[name] == "diff":
+      with stage("database") as s:
+        s.rowsOut = database.update_observations(name, inputDigests[name], contributor, read_observed(observed))
+    updated["inputs"][name] = {"sha256": inputDigests[name], "contributor": contributor,
+                               "unmapped": diff_to_columns(diff_df), "coverage": coverage.to_columns()}
+    coverages.append((contributor, coverage))
+    weighted.append(diff_df[KEY_COLUMNS].assign(Contributor=contributor, frequency=row_weights(diff_df)))
+    diffs.append(label_diff(diff_df.copy(), contributor))
+    if args.verbose:
+      print(diffs[-1])
+
+  all_diffs = pd.concat(diffs) if diffs else None
+
+  # coverage of the mapping table alone, before auto-mapping
+  with stage("coverage") as s:
+    report = coverage_report(coverages, index, pd.concat(weighted) if weighted else None, args.coverage_top)
+    write_report(report, os.path.join(args.root, "pending", "StudyDescription_coverage.json"))
+  for contributor in report["contributors"]:
+    print(f"{contributor['Contributor']}: {contributor['mapped']} of {contributor['total']} studies mapped ({contributor['coverage']})")
+
+  automapped = None
+  automappedName = os.path.join(args.root, "pending", "StudyDescription_automapped.csv")
+  # rows the rules map go to pending/StudyDescription_automapped.csv with the rule that fired,
+  # for review, instead of to the diff
+  if automapDigest is not None and all_diffs is not None:
+    ruleSet = load_rules(args.root)
+    with stage("automap", len(all_diffs)) as s:
+      automapped, all_diffs = ruleSet.apply(all_diffs)
+      s.rowsOut = len(all_diffs)
+    print(f"{len(automapped)} unmapped row(s) auto-mapped by {len(ruleSet)} rule(s)")
+
+    with stage("write", len(automapped)) as s:
+      automapped = automapped.sort_values(by=["frequency"], ascending=False)
+      automapped["frequency"] = automapped["frequency"].astype(object).fillna("N/A")
+      automapped.to_csv(automappedName, index=False)
+      s.rowsOut = len(automapped)
+
+  tail = None
+  tailName = os.path.join(args.root, "pending", "StudyDescription_diffs_tail.csv")
+  if all_diffs is not None and not all_diffs.empty:
+    with stage("sort", len(all_diffs)) as s:
+      if args.top is not None and args.top < len(all_diffs):
+        all_diffs, tail = top_rows(all_diffs, args.top)
+      else:
+        all_diffs.sort_values(by=["frequency"], inplace=True, ascending=False)
+      s.rowsOut = len(all_diffs)
+
+    with stage("write", len(all_diffs) + (len(tail) if tail is not None else 0)) as s:
+      if args.parquet:
+        write_parquet(pd.concat([all_diffs, tail]) if tail is not None else all_diffs,
+                      os.path.join(args.root, "pending", "StudyDescription_diffs.parquet"), ["Modality", "Contributor"])
+
+      all_diffs["frequency"] = all_diffs["frequency"].astype(object).fillna("N/A")
+
+      all_diffs.to_csv(os.path.join(args.root, "pending", "StudyDescription_diffs.csv"), index=False)
+      s.rowsOut = len(all_diffs)
+      if tail is not None:
+        tail = tail.assign(frequency=tail["frequency"].astype(object).fillna("N/A"))
+        tail.to_csv(tailName, index=False)
+        s.rowsOut += len(tail)
+
+    # nearest mapped descriptions of the same Modality, to help curators map the pending values;
+    # with --top only the rows of the sorted head, which are the ones reviewed
+    if args.suggestions > 0:
+      with stage("suggest", len(all_diffs)) as s:
+        suggestions = suggest_for(all_diffs, SuggestionIndex(index.rows), args.suggestions)
+        suggestions.to_csv(os.path.join(args.root, "pending", "StudyDescription_suggestions.csv"), index=False)
+        s.rowsOut = len(suggestions)
+
+  # a tail left by an earlier --top run would be stale, and so would auto-mapped rows of a run with rules
+  if tail is None and os.path.exists(tailName):
+    os.remove(tailName)
+  if automapped is None and os.path.exists(automappedName):
+    os.remove(automappedName)
+
+  if database is not None:
+    with stage("database") as s:
+      recorded = database.digests()
+      mappingName, attributesName = sourceDigests
+      if recorded.get(mappingName) != sourceDigests[mappingName]:
+        database.update_mappings(mappingName, sourceDigests[mappingName], index.rows, index.exactSpellings)
+      if recorded.get(attributesName) != sourceDigests[attributesName]:
+        attributes = pd.read_csv(attributes_path(args.root), encoding="utf-8-sig", dtype=str)
+        database.update_attributes(attributesName, sourceDigests[attributesName], attributes)
+      database.remove_inputs(database.removed_inputs(inputDigests))
+      database.replace_pending(pd.concat([all_diffs, tail]) if tail is not None else all_diffs, automapped)
+      database.close()
 
-# rename columns if all_diffs is not empty only
-if not all_diffs.empty:
-  all_diffs = all_diffs.rename(columns={"frequency_x": "frequency"})
+  with stage("write"):
+    write_manifest(args.root, updated)
 
-  all_diffs.sort_values(by=["frequency"], inplace=True, ascending=False)
+  recorder.print_table()
+  if args.metrics:
+    recorder.write_json(args.metrics)
+  if args.openmetrics:
+    recorder.write_openmetrics(args.openmetrics)
 
-  all_diffs.to_csv(os.path.join(sys.argv[1], "pending", "StudyDescription_diffs.csv"), index=False)
+if __name__ == "__main__":
+  main()
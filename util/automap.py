@@ -0,0 +1,167 @@
+import pandas as pd
+import numpy as np
+import os
+import re
+
+from mapping_index import attributes_path
+from modality import vocabulary
+from normalization import normalize_value
+
+# Rule-based auto-mapping of unmapped StudyDescription values.
+#
+# out/StudyDescription_rules.csv holds one rule per row:
+#
+#   Rule ID           name reported with every row the rule maps
+#   Modality          optional comma list of the modalities the rule applies to
+#   Required          keyword groups separated by ";", every group must match; alternatives of a
+#                     group are separated by "|"
+#   Excluded          keywords separated by "|", none may match
+#   LOINC code        code the rule maps to, which must be in StudyDescription_filtering_attributes.csv
+#
+# Keywords are whole words or phrases, normalized like the descriptions and matched on their words,
+# so "W/O", "WO" and "WITHOUT" are the same keyword. The first matching rule of the file wins. A keyword
+# inside a longer keyword that matched at the same place does not count on its own: the W of W/O is
+# not a W, and the PORTABLE of NOT PORTABLE is not a PORTABLE.
+#
+# The keywords of all rules are compiled into one Aho-Corasick automaton over words, so every
+# distinct description is scanned once whatever the number of rules.
+
+RULE_COLUMNS = ["Rule ID", "Modality", "Required", "Excluded", "LOINC code"]
+
+WORDS = re.compile(r"[A-Z0-9]+")
+
+def rules_path(root):
+  return os.path.join(root, "out", "StudyDescription_rules.csv")
+
+def words(text):
+  return tuple(WORDS.findall(str(text).upper()))
+
+class KeywordAutomaton:
+
+  # keywords: word tuples, matched keywords are reported by their position in the list
+  def __init__(self, keywords):
+    self.goto = [{}]
+    self.fail = [0]
+    # (keyword, length in words) of the keywords ending in each state
+    self.outputs = [[]]
+
+    for keyword, phrase in enumerate(keywords):
+      state = 0
+      for word in phrase:
+        if word not in self.goto[state]:
+          self.goto.append({})
+          self.fail.append(0)
+          self.outputs.append([])
+          self.goto[state][word] = len(self.goto) - 1
+        state = self.goto[state][word]
+      self.outputs[state].append((keyword, len(phrase)))
+
+    # fail links in breadth-first order, each state inheriting the outputs of its fail state
+    queue = list(self.goto[0].values())
+    for state in queue:
+      for word, child in self.goto[state].items():
+        queue.append(child)
+        fallback = self.fail[state]
+        while fallback and word not in self.goto[fallback]:
+          fallback = self.fail[fallback]
+        self.fail[child] = self.goto[fallback].get(word, 0)
+        self.outputs[child] = self.outputs[child] + self.outputs[self.fail[child]]
+
+  # (start, end, keyword) of every occurrence in a word tuple
+  def occurrences(self, text):
+    found = []
+    state = 0
+    for end, word in enumerate(text, 1):
+      while state and word not in self.goto[state]:
+        state = self.fail[state]
+      state = self.goto[state].get(word, 0)
+      found.extend((end - length, end, keyword) for keyword, length in self.outputs[state])
+    return found
+
+  # keywords of a word tuple, without those only found inside a longer occurrence
+  def search(self, text):
+    found = self.occurrences(text)
+    return {keyword for start, end, keyword in found
+            if not any(s <= start and end <= e and e - s > end - start for s, e, _ in found)}
+
+def split_keywords(cell, separator):
+  return [w for w in (words(normalize_value(k)) for k in str(cell).split(separator)) if w]
+
+class RuleSet:
+
+  def __init__(self, rules, attributes):
+    rules = rules.fillna("")
+    for column in RULE_COLUMNS:
+      if column not in rules.columns:
+        raise ValueError(f"rules have no {column!r} column")
+
+    rules["LOINC code"] = rules["LOINC code"].str.strip()
+    unknown = ~rules["LOINC code"].isin(attributes.index)
+    if unknown.any():
+      raise ValueError(f"rules {', '.join(rules.loc[unknown, 'Rule ID'])} map to LOINC codes missing from the filtering attributes")
+
+    keywords = {}
+    def keyword_ids(phrases):
+      return frozenset(keywords.setdefault(p, len(keywords)) for p in phrases)
+
+    self.ids = rules["Rule ID"].tolist()
+    self.codes = rules["LOINC code"].tolist()
+    self.names = [attributes[c] for c in self.codes]
+    self.modalities = [frozenset(vocabulary.tokens(m)) if m.strip() else None for m in rules["Modality"]]
+    self.required = [[keyword_ids(split_keywords(group, "|")) for group in str(cell).split(";") if split_keywords(group, "|")]
+                     for cell in rules["Required"]]
+    self.excluded = [keyword_ids(split_keywords(cell, "|")) for cell in rules["Excluded"]]
+
+    for ruleId, required in zip(self.ids, self.required):
+      if not required:
+        raise ValueError(f"rule {ruleId} has no required keyword")
+
+    self.automaton = KeywordAutomaton(list(keywords))
+
+  def __len__(self):
+    return len(self.ids)
+
+  # position of the first rule matching the keywords found in a description, -1 if none does
+  def first_match(self, found, modality):
+    codes = set(str(modality).split(",")) if isinstance(modality, str) else set()
+    for rule, (modalities, required, excluded) in enumerate(zip(self.modalities, self.required, self.excluded)):
+      if modalities is not None and not (codes and codes <= modalities):
+        continue
+      if all(group & found for group in required) and not excluded & found:
+        return rule
+    return -1
+
+  # rule position of every (StudyDescription, Modality) row, -1 where no rule matches; each distinct
+  # description is scanned once and each distinct key matched once
+  def match(self, descriptions, modalities):
+    keys = pd.MultiIndex.from_arrays([descriptions, modalities])
+    codes, uniques = pd.factorize(keys)
+    found = {}
+    matched = np.empty(len(uniques) + 1, dtype=np.intp)
+    for i, (description, modality) in enumerate(uniques):
+      if description not in found:
+        found[description] = self.automaton.search(words(description)) if isinstance(description, str) else set()
+      matched[i] = self.first_match(found[description], modality)
+    matched[-1] = -1
+    return matched[codes]
+
+  # (auto-mapped rows with their LOINC code, name and rule, rows left unmapped)
+  def apply(self, diff_df):
+    matched = self.match(diff_df["StudyDescription"].to_numpy(), diff_df["Modality"].to_numpy())
+    hit = matched >= 0
+    mapped = diff_df[hit].copy()
+    rules = matched[hit]
+    mapped["LOINC code"] = np.array(self.codes, dtype=object)[rules]
+    mapped["L-Long Common Name"] = np.array(self.names, dtype=object)[rules]
+    mapped["Rule ID"] = np.array(self.ids, dtype=object)[rules]
+    return mapped, diff_df[~hit]
+
+# rules of a repository root, None when it has no rules file
+def load_rules(root):
+  if not os.path.exists(rules_path(root)):
+    return None
+  rules = pd.read_csv(rules_path(root), encoding="utf-8-sig", dtype=str, keep_default_na=False)
+  attributes = pd.read_csv(attributes_path(root), encoding="utf-8-sig", dtype=str)
+  attributes["LOINC code"] = attributes["LOINC code"].str.strip()
+  names = attributes.drop_duplicates(subset=["LOINC code"]).set_index("LOINC code")["L-Long Common Name"]
+  return RuleSet(rules, names)
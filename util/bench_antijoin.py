@@ -0,0 +1,74 @@
+import pandas as pd
+import numpy as np
+import argparse
+import time
+import multiprocessing as mp
+
+from mapping_index import MappingIndex
+from instrumentation import peak_rss_bytes
+
+MODALITIES = ["CT", "CR", "DX", "MR", "US", "NM", "PT", "RF", "MG", "XA"]
+
+# synthetic input: `rows` rows drawn from `distinct` descriptions, a `mapped` subset of them in the mapping table
+def synthetic_frames(rows, distinct, mapped, seed=0):
+  rng = np.random.default_rng(seed)
+  descriptions = np.array([f"SYNTHETIC STUDY {i}" for i in range(distinct)], dtype=object)
+  modalities = np.array(MODALITIES, dtype=object)
+
+  in_df = pd.DataFrame({
+    "Modality": modalities[rng.integers(0, len(modalities), rows)],
+    "StudyDescription": descriptions[rng.integers(0, distinct, rows)],
+    "frequency": rng.integers(1, 1000, rows),
+  })
+  out_df = pd.DataFrame({
+    "Modality": modalities[rng.integers(0, len(modalities), mapped)],
+    "StudyDescription": descriptions[rng.choice(distinct, mapped, replace=False)],
+    "LOINC code": "00000-0",
+    "L-Long Common Name": "Synthetic",
+  })
+  return in_df, out_df
+
+# peak RSS in MB, None where the platform does not report it
+def max_rss_mb():
+  peak = peak_rss_bytes()
+  return peak / 2**20 if peak is not None else None
+
+def merge_engine(in_df, out_df):
+  diff_df = pd.merge(in_df, out_df, on=["StudyDescription", "Modality"], how="outer", indicator=True)
+  return diff_df[diff_df["_merge"] == "left_only"]
+
+def index_engine(in_df, out_df):
+  return MappingIndex(out_df).unmapped(in_df)
+
+ENGINES = {"merge": merge_engine, "index": index_engine}
+
+# each engine runs in its own process so that peak RSS is not shared between them
+def run_engine(name, args, queue):
+  in_df, out_df = synthetic_frames(args.rows, args.distinct, args.mapped)
+  baseline = max_rss_mb()
+
+  start = time.perf_counter()
+  unmapped = ENGINES[name](in_df, out_df)
+  elapsed = time.perf_counter() - start
+
+  peak = max_rss_mb() - baseline if baseline is not None else None
+  queue.put({"engine": name, "seconds": elapsed, "unmapped": len(unmapped), "peak_rss_mb": peak})
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Compare the outer-merge diff with the hash-index anti-join")
+  parser.add_argument("--rows", type=int, default=10_000_000)
+  parser.add_argument("--distinct", type=int, default=200_000)
+  parser.add_argument("--mapped", type=int, default=50_000)
+  args = parser.parse_args(argv)
+
+  queue = mp.Queue()
+  for name in ENGINES:
+    process = mp.Process(target=run_engine, args=(name, args, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    peak = f"{result['peak_rss_mb']:8.0f}" if result["peak_rss_mb"] is not None else f"{'-':>8}"
+    print(f"{result['engine']:>6}: {result['seconds']:8.2f} s  {peak} MB above input  {result['unmapped']} unmapped rows")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,117 @@
+import pandas as pd
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tempfile
+
+from mapping_index import MappingIndex, mapping_table_path, read_mapping_table
+from analyze_in_out import (discover_inputs, input_separator, contributor_from_filename, normalize_input, aggregate_input,
+                            unmapped_rows, decode_keys, label_diff)
+from bench_antijoin import max_rss_mb
+from synthetic_workload import generate
+
+# Stage timings of the analyze_in_out.py pipeline on a workload root, written as JSON so runs can
+# be compared across commits:
+#
+#   python util/bench_pipeline.py --rows 10000000 --mapping-rows 100000 -o bench.json
+#   python util/bench_pipeline.py /tmp/workload -o bench.json
+#
+# Peak RSS is the peak of the process at the end of each stage, so it only grows from stage to stage.
+
+def git_commit():
+  try:
+    return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+  except OSError:
+    return None
+
+class StageTimer:
+
+  def __init__(self):
+    self.stages = {}
+
+  def run(self, name, rows, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    seconds = time.perf_counter() - start
+    count = rows(result) if callable(rows) else rows
+    peak = max_rss_mb()
+    self.stages[name] = {
+      "seconds": round(seconds, 4),
+      "peak_rss_mb": round(peak, 1) if peak is not None else None,
+      "rows": count,
+      "rows_per_second": round(count / seconds) if seconds > 0 else None,
+    }
+    peakText = f"{peak:8.0f}" if peak is not None else f"{'-':>8}"
+    print(f"{name:>10}: {seconds:8.2f} s  {peakText} MB peak  {count} rows", file=sys.stderr)
+    return result
+
+def read_inputs(fileNames):
+  return [pd.read_csv(f, sep=input_separator(f)) for f in fileNames]
+
+def write_diffs(diffs, fileName):
+  all_diffs = pd.concat(diffs)
+  all_diffs.sort_values(by=["frequency"], inplace=True, ascending=False)
+  all_diffs["frequency"] = all_diffs["frequency"].astype(object).fillna("N/A")
+  all_diffs.to_csv(fileName, index=False)
+  return all_diffs
+
+def benchmark(root, outputDir):
+  fileNames = discover_inputs(root)
+  timer = StageTimer()
+
+  frames = timer.run("load", lambda frames: sum(len(f) for f in frames), read_inputs, fileNames)
+  rows = sum(len(f) for f in frames)
+  index = timer.run("index", len, lambda: MappingIndex(read_mapping_table(mapping_table_path(root))))
+  frames = timer.run("normalize", rows, lambda: [normalize_input(f, index) for f in frames])
+  diffs = timer.run("diff", rows, lambda: [decode_keys(unmapped_rows(aggregate_input(f).reset_index(), index, coded=True), index)
+                                           for f in frames])
+  del frames
+  diffs = [label_diff(d, contributor_from_filename(f)) for d, f in zip(diffs, fileNames)]
+  timer.run("write", len, write_diffs, diffs, os.path.join(outputDir, "StudyDescription_diffs.csv"))
+
+  return {
+    "commit": git_commit(),
+    "python": platform.python_version(),
+    "pandas": pd.__version__,
+    "inputs": [os.path.basename(f) for f in fileNames],
+    "input_rows": rows,
+    "mapping_rows": len(index),
+    "unmapped_rows": timer.stages["write"]["rows"],
+    "total_seconds": round(sum(s["seconds"] for s in timer.stages.values()), 4),
+    "stages": timer.stages,
+  }
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Time the stages of the StudyDescription diff pipeline")
+  parser.add_argument("root", nargs="?", default=None,
+                      help="workload root containing in/ and out/ (default: generate one in a temporary directory)")
+  parser.add_argument("-o", "--output", default="bench_pipeline.json", help="JSON file of the results")
+  parser.add_argument("--rows", type=int, default=1_000_000, help="input rows of the generated workload")
+  parser.add_argument("--mapping-rows", type=int, default=None, help="mapping table rows of the generated workload")
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args(argv)
+
+  with tempfile.TemporaryDirectory() as workDir:
+    root = args.root
+    if root is None:
+      root = workDir
+      start = time.perf_counter()
+      generate(root, args.rows, args.mapping_rows, seed=args.seed)
+      print(f"Generated {args.rows} rows in {time.perf_counter() - start:.2f} s", file=sys.stderr)
+
+    # diff output goes to the temporary directory, so a real pending/ is never overwritten
+    results = benchmark(root, workDir)
+    if args.root is None:
+      results["workload"] = {"rows": args.rows, "mapping_rows": args.mapping_rows, "seed": args.seed}
+
+  with open(args.output, "w") as f:
+    json.dump(results, f, indent=2)
+  print(f"Results written to {args.output}", file=sys.stderr)
+
+if __name__ == "__main__":
+  main()
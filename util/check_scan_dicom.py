@@ -0,0 +1,125 @@
+import os
+import sys
+import csv
+import shutil
+import tempfile
+import argparse
+
+import scan_dicom
+
+# Self-check of util/scan_dicom.py: writes a small tree of DICOM headers with pydicom in a temporary
+# directory, scans it with and without a ledger and compares the TSV with the expected counts. The
+# tree has a study with series of two modalities, a study with two files of one series, a file that
+# is not DICOM and a subdirectory that is removed between two ledger scans.
+#
+#   python util/check_scan_dicom.py
+
+try:
+  from pydicom.dataset import Dataset, FileMetaDataset
+  from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+except ImportError:
+  Dataset = None
+
+# (path, StudyInstanceUID, Modality, StudyDescription) of the DICOM files of the tree
+FILES = [
+  ("petct/ct.dcm", "1.2.3.1", "CT", "PET CT WHOLE BODY"),
+  ("petct/pt.dcm", "1.2.3.1", "PT", "PET CT WHOLE BODY"),
+  ("head/1.dcm", "1.2.3.2", "CT", "CT HEAD WO"),
+  ("head/2.dcm", "1.2.3.2", "CT", "CT HEAD WO"),
+  ("head/other.dcm", "1.2.3.3", "CT", "CT HEAD WO"),
+  ("brain/mr.dcm", "1.2.3.4", "MR", "MR BRAIN"),
+]
+
+EXPECTED = {
+  ("CT,PT", "PET CT WHOLE BODY"): 1,
+  ("CT", "CT HEAD WO"): 2,
+  ("MR", "MR BRAIN"): 1,
+}
+
+def write_header(fileName, studyUID, modality, description):
+  os.makedirs(os.path.dirname(fileName), exist_ok=True)
+  ds = Dataset()
+  ds.file_meta = FileMetaDataset()
+  ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+  ds.file_meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.7"
+  ds.file_meta.MediaStorageSOPInstanceUID = generate_uid()
+  ds.SOPInstanceUID = ds.file_meta.MediaStorageSOPInstanceUID
+  ds.StudyInstanceUID = studyUID
+  ds.Modality = modality
+  ds.StudyDescription = description
+  try:
+    ds.save_as(fileName, enforce_file_format=True)
+  except TypeError:
+    # pydicom < 3
+    ds.save_as(fileName, write_like_original=False)
+
+def write_tree(top):
+  for path, studyUID, modality, description in FILES:
+    write_header(os.path.join(top, path), studyUID, modality, description)
+  with open(os.path.join(top, "head", "notes.txt"), "w") as f:
+    f.write("not a DICOM file\n")
+
+def read_frequencies(fileName):
+  with open(fileName, newline="") as f:
+    return {(row["Modality"], row["StudyDescription"]): int(row["frequency"])
+            for row in csv.DictReader(f, delimiter="\t")}
+
+class Checks:
+
+  def __init__(self):
+    self.failed = 0
+
+  def equal(self, name, found, expected):
+    if found == expected:
+      print(f"ok    {name}")
+    else:
+      self.failed += 1
+      print(f"FAIL  {name}: {found!r} != {expected!r}")
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Check util/scan_dicom.py on a generated tree of DICOM files")
+  parser.add_argument("--jobs", type=int, default=1, help="worker processes reading headers")
+  args = parser.parse_args(argv)
+
+  if Dataset is None or scan_dicom.pydicom is None:
+    sys.exit("check_scan_dicom.py requires pydicom (pip install pydicom)")
+
+  checks = Checks()
+  work = tempfile.mkdtemp(prefix="check_scan_dicom-")
+  try:
+    top = os.path.join(work, "dicom")
+    ledger = os.path.join(work, "scan.sqlite")
+    output = os.path.join(work, "StudyDescriptions_check.tsv")
+    write_tree(top)
+
+    counts, collector = scan_dicom.scan(top, args.jobs)
+    checks.equal("studies per (Modality, StudyDescription)", dict(counts), EXPECTED)
+    checks.equal("files skipped as not DICOM", collector.skipped, 1)
+
+    scan_dicom.write_frequencies(counts, output)
+    checks.equal("TSV", read_frequencies(output), EXPECTED)
+
+    counts, progress = scan_dicom.scan_with_ledger(top, ledger, args.jobs)
+    checks.equal("first ledger scan", dict(counts), EXPECTED)
+    checks.equal("first ledger scan reads every file", progress["read"], len(FILES) + 1)
+
+    counts, progress = scan_dicom.scan_with_ledger(top, ledger, args.jobs)
+    checks.equal("repeated ledger scan", dict(counts), EXPECTED)
+    checks.equal("repeated ledger scan reads no file", (progress["read"], progress["unchanged"]), (0, len(FILES) + 1))
+
+    # a new study and a removed directory
+    write_header(os.path.join(top, "head", "new.dcm"), "1.2.3.5", "CT", "CT HEAD WO")
+    shutil.rmtree(os.path.join(top, "brain"))
+    counts, progress = scan_dicom.scan_with_ledger(top, ledger, args.jobs)
+    checks.equal("resumed ledger scan", dict(counts), {("CT,PT", "PET CT WHOLE BODY"): 1, ("CT", "CT HEAD WO"): 3})
+    checks.equal("resumed ledger scan reads the new file", progress["read"], 1)
+    checks.equal("resumed ledger scan drops the removed file", progress["removed"], 1)
+  finally:
+    shutil.rmtree(work, ignore_errors=True)
+
+  if checks.failed:
+    sys.exit(f"{checks.failed} check(s) failed")
+  print("all checks passed")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,160 @@
+import pandas as pd
+import numpy as np
+import sys
+import time
+import argparse
+
+from mapping_index import ATTRIBUTE_COLUMNS, read_filtering_attributes
+from harmonize import Harmonizer
+from system_expression import parse_expression, terms
+
+# Cohort selection over harmonized studies.
+#
+# Every study is joined to the LOINC attributes for filtering through its LOINC code. For each
+# attribute value a packed bitmap (one bit per study) is built once; compound values such as
+# `Chest+Abdomen+Pelvis` or `CT && CT.angio` are indexed under each of their components, and
+# dotted values such as `CT.angio` also under their parent `CT`. A query is then a few bitwise
+# AND/OR operations over the bitmaps.
+#
+#   engine = CohortEngine.from_studies(harmonize(df, root), read_filtering_attributes(root))
+#   selected = engine.select({"L-Method": "CT", "L-System": "Chest", "Rad.Timing": "W"})
+#   selected.count(), selected.indices()
+
+INDEXED_COLUMNS = ["LOINC code"] + ATTRIBUTE_COLUMNS
+
+# popcount of every byte value, for numpy versions without bitwise_count
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+# names a compound attribute value is indexed under; values are parsed once per distinct string
+def components(value):
+  return terms(parse_expression(value))
+
+class Bitmap:
+
+  def __init__(self, bits, size):
+    self.bits = bits
+    self.size = size
+
+  @classmethod
+  def from_mask(cls, mask):
+    return cls(np.packbits(mask), len(mask))
+
+  @classmethod
+  def empty(cls, size):
+    return cls(np.zeros((size + 7) // 8, dtype=np.uint8), size)
+
+  def __and__(self, other):
+    return Bitmap(self.bits & other.bits, self.size)
+
+  def __or__(self, other):
+    return Bitmap(self.bits | other.bits, self.size)
+
+  def __invert__(self):
+    # clear the padding bits of the last byte
+    bits = ~self.bits
+    if self.size % 8:
+      bits[-1] &= np.uint8((0xFF << (8 - self.size % 8)) & 0xFF)
+    return Bitmap(bits, self.size)
+
+  def count(self):
+    return int(POPCOUNT[self.bits].sum(dtype=np.int64))
+
+  def mask(self):
+    return np.unpackbits(self.bits, count=self.size).astype(bool)
+
+  def indices(self):
+    return np.flatnonzero(self.mask())
+
+class CohortEngine:
+
+  # codes: integer LOINC code of every study (-1 when not mapped), into loincCodes
+  def __init__(self, codes, loincCodes, attributes):
+    self.size = len(codes)
+
+    # one bitmap per LOINC code, built from a single sort of the study codes
+    order = np.argsort(codes, kind="stable")
+    bounds = np.searchsorted(codes[order], np.arange(len(loincCodes) + 1))
+    perCode = {}
+    for i, code in enumerate(loincCodes):
+      if bounds[i] == bounds[i + 1]:
+        continue
+      mask = np.zeros(self.size, dtype=bool)
+      mask[order[bounds[i]:bounds[i + 1]]] = True
+      perCode[code] = Bitmap.from_mask(mask)
+
+    # attribute value bitmaps are unions of the LOINC code bitmaps carrying that value
+    attributes = attributes.drop_duplicates(subset=["LOINC code"]).set_index("LOINC code")
+    self.bitmaps = {column: {} for column in INDEXED_COLUMNS}
+    for code, bitmap in perCode.items():
+      self.add(self.bitmaps["LOINC code"], code, bitmap)
+      if code not in attributes.index:
+        continue
+      for column in ATTRIBUTE_COLUMNS:
+        for value in components(attributes.at[code, column]):
+          self.add(self.bitmaps[column], value, bitmap)
+
+  @staticmethod
+  def add(values, value, bitmap):
+    values[value] = values[value] | bitmap if value in values else bitmap
+
+  @classmethod
+  def from_studies(cls, studies, attributes):
+    codes, loincCodes = pd.factorize(studies["LOINC code"].astype(object).str.strip())
+    return cls(codes, list(loincCodes), attributes)
+
+  def values(self, column):
+    return sorted(self.bitmaps[column])
+
+  def bitmap(self, column, value):
+    return self.bitmaps[column].get(value) or Bitmap.empty(self.size)
+
+  # conditions: {column: value or list of values}; values of one column are ORed, columns ANDed
+  def select(self, conditions):
+    selected = ~Bitmap.empty(self.size)
+    for column, values in conditions.items():
+      if isinstance(values, str):
+        values = [values]
+      matched = Bitmap.empty(self.size)
+      for value in values:
+        matched = matched | self.bitmap(column, value)
+      selected = selected & matched
+    return selected
+
+# "L-Method=CT" or "Rad.Timing=W|WO"
+def parse_condition(text):
+  column, sep, values = text.partition("=")
+  if not sep or column not in INDEXED_COLUMNS:
+    raise argparse.ArgumentTypeError(f"expected <column>=<value>[|<value>...] with column one of {', '.join(INDEXED_COLUMNS)}")
+  return column, values.split("|")
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Select studies by LOINC filtering attributes")
+  parser.add_argument("root", help="repository root containing out/")
+  parser.add_argument("studies", help="CSV/TSV of studies with Modality and StudyDescription columns, or a LOINC code column")
+  parser.add_argument("--where", action="append", type=parse_condition, default=[],
+                      help="condition such as L-System=Chest or Rad.Timing=W|WO, repeat to AND conditions")
+  parser.add_argument("-o", "--output", default=None, help="CSV of the selected studies")
+  parser.add_argument("--cache-dir", default=None,
+                      help="directory of compiled mapping indexes (default: <root>/.cache)")
+  args = parser.parse_args(argv)
+
+  studies = pd.read_csv(args.studies, sep="\t" if args.studies.endswith(".tsv") else ",", dtype=str)
+  if "LOINC code" not in studies.columns:
+    studies = Harmonizer(args.root, args.cache_dir).harmonize(studies)
+
+  start = time.perf_counter()
+  engine = CohortEngine.from_studies(studies, read_filtering_attributes(args.root))
+  print(f"Indexed {engine.size} studies in {time.perf_counter() - start:.2f} s", file=sys.stderr)
+
+  start = time.perf_counter()
+  conditions = {}
+  for column, values in args.where:
+    conditions.setdefault(column, []).extend(values)
+  selected = engine.select(conditions)
+  print(f"{selected.count()} of {engine.size} studies selected in {(time.perf_counter() - start) * 1000:.2f} ms")
+
+  if args.output:
+    studies.iloc[selected.indices()].to_csv(args.output, index=False)
+
+if __name__ == "__main__":
+  main()
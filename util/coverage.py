@@ -0,0 +1,113 @@
+import pandas as pd
+import numpy as np
+import json
+
+from modality import BLANK
+
+# Frequency-weighted coverage of the inputs by the mapping table.
+#
+# The anti-join of analyze_in_out.py locates every aggregated key in the mapping index anyway, so
+# the weights of the located and unlocated keys are accumulated there, per Modality and per mapping
+# key, before the mapped rows are dropped. Rows are weighted by their frequency, or by the number of
+# input rows they aggregate when a file has no frequency column. The counters of every input file are kept in the manifest with its
+# unmapped rows, so files that are not re-read keep their coverage.
+
+class Coverage:
+
+  def __init__(self):
+    # Modality -> [total weight, mapped weight]
+    self.modalities = {}
+    # (StudyDescription, Modality) of the mapping table -> mapped weight
+    self.keys = {}
+
+  # accumulate the rows of a frame: their Modality (names, or vocabulary codes turned into names by
+  # decode), their positions in the mapping index (-1 when unmapped) and weights; with recount the
+  # rows are already in the totals, e.g. cached unmapped rows found mapped on a recheck
+  def add(self, indexRows, modalities, positions, weights, decode=None, recount=False):
+    values, uniques = pd.factorize(np.asarray(modalities))
+    names = decode(uniques) if decode is not None else np.asarray(uniques, dtype=object)
+    names = [n if isinstance(n, str) else BLANK for n in names] + [BLANK]
+    # missing values (-1) count under the trailing [blank]
+    values = np.where(values < 0, len(uniques), values)
+
+    mapped = positions >= 0
+    total = np.bincount(values, weights, minlength=len(names))
+    covered = np.bincount(values[mapped], weights[mapped], minlength=len(names))
+    for i in np.flatnonzero(np.bincount(values, minlength=len(names))):
+      counters = self.modalities.setdefault(names[i], [0, 0])
+      if not recount:
+        counters[0] += int(total[i])
+      counters[1] += int(covered[i])
+
+    # mapped weight per key of the mapping table
+    byPosition = np.bincount(positions[mapped], weights[mapped], minlength=len(indexRows))
+    for p in np.flatnonzero(np.bincount(positions[mapped], minlength=len(indexRows))):
+      key = (indexRows["StudyDescription"].iat[p], indexRows["Modality"].iat[p])
+      self.keys[key] = self.keys.get(key, 0) + int(byPosition[p])
+
+  def to_columns(self):
+    return {"modalities": self.modalities, "keys": [[d, m, w] for (d, m), w in self.keys.items()]}
+
+  @classmethod
+  def from_columns(cls, columns):
+    coverage = cls()
+    coverage.modalities = {m: list(c) for m, c in columns["modalities"].items()}
+    coverage.keys = {(d, m): w for d, m, w in columns["keys"]}
+    return coverage
+
+# weight of every row of an aggregated frame
+def row_weights(df):
+  if "frequency" not in df.columns:
+    if "rows" in df.columns:
+      return df["rows"].to_numpy(dtype=np.int64)
+    return np.ones(len(df), dtype=np.int64)
+  return pd.to_numeric(df["frequency"], errors="coerce").fillna(0).to_numpy(dtype=np.int64)
+
+def ratio(mapped, total):
+  return round(mapped / total, 4) if total else None
+
+# summary of the (contributor, Coverage) pairs of the input files: totals per contributor and per
+# (contributor, Modality), mapped weight per LOINC code, and the `top` heaviest unmapped rows of diffs
+# (StudyDescription, Modality, Contributor and the row weight as frequency)
+def coverage_report(coverages, index, diffs, top):
+  modalities = pd.DataFrame([(contributor, modality, total, mapped)
+                             for contributor, coverage in coverages
+                             for modality, (total, mapped) in coverage.modalities.items()],
+                            columns=["Contributor", "Modality", "total", "mapped"])
+  modalities = modalities.groupby(["Contributor", "Modality"], as_index=False).sum()
+  contributors = modalities.groupby("Contributor", as_index=False)[["total", "mapped"]].sum()
+  for df in (modalities, contributors):
+    df["unmapped"] = df["total"] - df["mapped"]
+    df["coverage"] = [ratio(m, t) for m, t in zip(df["mapped"], df["total"])]
+
+  # mapped keys are resolved to their LOINC code in the current mapping table
+  keys = pd.DataFrame([(contributor, d, m, w) for contributor, coverage in coverages
+                       for (d, m), w in coverage.keys.items()],
+                      columns=["Contributor", "StudyDescription", "Modality", "frequency"])
+  positions = index.locate(keys)
+  keys = keys[positions >= 0]
+  codes = index.rows.iloc[positions[positions >= 0]]
+  keys = keys.assign(**{"LOINC code": codes["LOINC code"].to_numpy(), "L-Long Common Name": codes["L-Long Common Name"].to_numpy()})
+  loincCodes = (keys.groupby(["LOINC code", "L-Long Common Name"], as_index=False)
+                .agg(frequency=("frequency", "sum"), contributors=("Contributor", "nunique"))
+                .sort_values("frequency", ascending=False, kind="stable"))
+
+  unmapped = pd.DataFrame(columns=["StudyDescription", "Modality", "Contributor", "frequency"])
+  if diffs is not None and not diffs.empty:
+    unmapped = diffs.nlargest(top, "frequency", keep="first")[unmapped.columns]
+
+  total, mapped = int(contributors["total"].sum()), int(contributors["mapped"].sum())
+  return {
+    "total": total,
+    "mapped": mapped,
+    "unmapped": total - mapped,
+    "coverage": ratio(mapped, total),
+    "contributors": contributors.to_dict(orient="records"),
+    "modalities": modalities.to_dict(orient="records"),
+    "loinc_codes": loincCodes.to_dict(orient="records"),
+    "top_unmapped": unmapped.to_dict(orient="records"),
+  }
+
+def write_report(report, fileName):
+  with open(fileName, "w") as f:
+    json.dump(report, f, indent=1, default=int)
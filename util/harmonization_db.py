@@ -0,0 +1,273 @@
+import pandas as pd
+import os
+import sys
+import sqlite3
+import argparse
+
+from normalization import NORMALIZATION_VERSION, exact_description, canonical_description
+from modality import vocabulary
+from coverage import row_weights
+
+# Single-file SQLite database of the harmonization state, kept up to date by analyze_in_out.py --database:
+#
+#   observations       normalized (Modality, StudyDescription) keys of every input file, with the
+#                      contributor, summed frequency (input rows for files without frequency, as
+#                      in the coverage report) and observed spellings; a file read in chunks
+#                      has one row per key and chunk, so queries sum over the rows of a key
+#   mappings           the exploded, normalized mapping table, one row per key
+#   exact_spellings    the exact descriptions the mapping index keeps apart (see MappingIndex)
+#   loinc_attributes   LOINC attributes for filtering, one row per LOINC code
+#   pending            the rows of pending/StudyDescription_diffs.csv and of the auto-mapped file
+#
+# Keys and LOINC codes have B-tree indexes, so lookups, cohort counts and "who contributed this
+# value" are indexed queries. The SHA-256 of every source file is recorded in `sources`, and only
+# the tables of files that changed are rewritten; a database written with other normalization rules
+# is rebuilt from scratch.
+#
+#   python util/harmonization_db.py . lookup CT "CT HEAD W/O CONTRAST"
+#   python util/harmonization_db.py . contributors CR "XR CHEST 2 VIEWS"
+#   python util/harmonization_db.py . counts L-System
+
+# bump when the tables change, so existing databases are rebuilt
+SCHEMA_VERSION = 3
+
+SCHEMA = """
+  CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+  CREATE TABLE IF NOT EXISTS sources (name TEXT PRIMARY KEY, sha256 TEXT NOT NULL);
+  CREATE TABLE IF NOT EXISTS observations (
+    source TEXT NOT NULL,
+    contributor TEXT NOT NULL,
+    modality TEXT,
+    study_description TEXT,
+    frequency INTEGER,
+    variants TEXT
+  );
+  CREATE INDEX IF NOT EXISTS observations_key ON observations (modality, study_description);
+  CREATE INDEX IF NOT EXISTS observations_source ON observations (source);
+  CREATE TABLE IF NOT EXISTS mappings (
+    modality TEXT NOT NULL,
+    study_description TEXT NOT NULL,
+    loinc_code TEXT,
+    long_common_name TEXT,
+    PRIMARY KEY (modality, study_description)
+  );
+  CREATE INDEX IF NOT EXISTS mappings_loinc_code ON mappings (loinc_code);
+  CREATE TABLE IF NOT EXISTS exact_spellings (study_description TEXT PRIMARY KEY);
+  CREATE TABLE IF NOT EXISTS loinc_attributes (
+    loinc_code TEXT PRIMARY KEY,
+    long_common_name TEXT,
+    method TEXT,
+    system TEXT,
+    timing TEXT,
+    midrc_system TEXT
+  );
+  CREATE TABLE IF NOT EXISTS pending (
+    modality TEXT,
+    study_description TEXT,
+    contributor TEXT,
+    frequency INTEGER,
+    variants TEXT,
+    loinc_code TEXT,
+    rule_id TEXT
+  );
+  CREATE INDEX IF NOT EXISTS pending_key ON pending (modality, study_description);
+  CREATE INDEX IF NOT EXISTS pending_loinc_code ON pending (loinc_code);
+"""
+
+# filtering attribute column -> loinc_attributes column
+ATTRIBUTE_NAMES = {
+  "L-Long Common Name": "long_common_name",
+  "L-Method": "method",
+  "L-System": "system",
+  "Rad.Timing": "timing",
+  "MIDRC-System": "midrc_system",
+}
+
+def database_path(cacheDir):
+  return os.path.join(cacheDir, "harmonization.sqlite")
+
+# SQLite values of a column, with missing values as NULL
+def sql_values(values):
+  return [None if pd.isna(v) else v for v in values]
+
+def sql_integers(values):
+  return [None if pd.isna(v) else int(v) for v in values]
+
+def variant_text(variants):
+  return variants if isinstance(variants, str) else " | ".join(variants)
+
+class HarmonizationDatabase:
+
+  def __init__(self, fileName):
+    self.fileName = fileName
+    os.makedirs(os.path.dirname(os.path.abspath(fileName)), exist_ok=True)
+    self.connection = sqlite3.connect(fileName)
+    self.connection.execute("PRAGMA journal_mode=WAL")
+    self.connection.execute("PRAGMA synchronous=NORMAL")
+
+    version = f"{SCHEMA_VERSION}.{NORMALIZATION_VERSION}"
+    if self.meta("version") not in (None, version):
+      self.drop()
+    self.connection.executescript(SCHEMA)
+    self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+    self.connection.commit()
+
+  def meta(self, key):
+    try:
+      row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    except sqlite3.OperationalError:
+      return None
+    return row[0] if row else None
+
+  def drop(self):
+    for table in ("meta", "sources", "observations", "mappings", "exact_spellings", "loinc_attributes", "pending"):
+      self.connection.execute(f"DROP TABLE IF EXISTS {table}")
+
+  def digests(self):
+    return dict(self.connection.execute("SELECT name, sha256 FROM sources"))
+
+  # input files whose observations are missing or were recorded from other contents
+  def stale_inputs(self, inputDigests):
+    recorded = self.digests()
+    return [name for name, digest in inputDigests.items() if recorded.get(name) != digest]
+
+  # input files recorded before that are no longer in inputDigests
+  def removed_inputs(self, inputDigests):
+    return [name for name in self.digests() if name.startswith("in/") and name not in inputDigests]
+
+  def is_current(self, digests):
+    recorded = self.digests()
+    return all(recorded.get(name) == digest for name, digest in digests.items())
+
+  def record_source(self, name, digest):
+    self.connection.execute("INSERT OR REPLACE INTO sources VALUES (?, ?)", (name, digest))
+
+  # observations of one input file, given as frames of aggregated rows, replacing those recorded
+  # for it before; returns the number of rows written
+  def update_observations(self, name, digest, contributor, frames):
+    self.connection.execute("DELETE FROM observations WHERE source = ?", (name,))
+    rows = 0
+    for observed in frames:
+      # the weights of the coverage report: frequency, or input rows for files without frequency
+      frequencies = row_weights(observed)
+      self.connection.executemany(
+        "INSERT INTO observations VALUES (?, ?, ?, ?, ?, ?)",
+        zip([name] * len(observed), [contributor] * len(observed), sql_values(observed["Modality"]),
+            sql_values(observed["StudyDescription"]), sql_integers(frequencies), map(variant_text, observed["Variants"])))
+      rows += len(observed)
+    self.record_source(name, digest)
+    return rows
+
+  # forget the input files that are gone from in/
+  def remove_inputs(self, names):
+    for name in names:
+      self.connection.execute("DELETE FROM observations WHERE source = ?", (name,))
+      self.connection.execute("DELETE FROM sources WHERE name = ?", (name,))
+
+  def update_mappings(self, name, digest, rows, exactSpellings=()):
+    self.connection.execute("DELETE FROM mappings")
+    self.connection.execute("DELETE FROM exact_spellings")
+    self.connection.executemany("INSERT INTO exact_spellings VALUES (?)", ((e,) for e in sorted(exactSpellings)))
+    self.connection.executemany(
+      "INSERT OR IGNORE INTO mappings VALUES (?, ?, ?, ?)",
+      zip(sql_values(rows["Modality"]), sql_values(rows["StudyDescription"]),
+          sql_values(rows["LOINC code"].str.strip()), sql_values(rows["L-Long Common Name"])))
+    self.record_source(name, digest)
+
+  def update_attributes(self, name, digest, attributes):
+    attributes = attributes.assign(**{"LOINC code": attributes["LOINC code"].str.strip()})
+    attributes = attributes.drop_duplicates(subset=["LOINC code"])
+    self.connection.execute("DELETE FROM loinc_attributes")
+    self.connection.executemany(
+      f"INSERT INTO loinc_attributes VALUES ({', '.join(['?'] * (len(ATTRIBUTE_NAMES) + 1))})",
+      zip(*(sql_values(attributes[c]) for c in ["LOINC code"] + list(ATTRIBUTE_NAMES))))
+    self.record_source(name, digest)
+
+  # the pending rows of this run, unmapped and auto-mapped
+  def replace_pending(self, unmapped, automapped=None):
+    self.connection.execute("DELETE FROM pending")
+    for df in (unmapped, automapped):
+      if df is None or df.empty:
+        continue
+      missing = [None] * len(df)
+      self.connection.executemany(
+        "INSERT INTO pending VALUES (?, ?, ?, ?, ?, ?, ?)",
+        zip(sql_values(df["Modality"]), sql_values(df["StudyDescription"]), sql_values(df["Contributor"]),
+            sql_integers(pd.to_numeric(df["frequency"], errors="coerce")), map(variant_text, df["Variants"]),
+            sql_values(df["LOINC code"]) if "LOINC code" in df.columns else missing,
+            sql_values(df["Rule ID"]) if "Rule ID" in df.columns else missing))
+
+  def commit(self):
+    self.connection.commit()
+
+  def close(self):
+    self.connection.commit()
+    self.connection.close()
+
+  # normalized key of one raw (Modality, StudyDescription), as MappingIndex.normalize_description
+  def key(self, modality, description):
+    text = exact_description(description)
+    found = self.connection.execute("SELECT 1 FROM exact_spellings WHERE study_description = ?", (text,)).fetchone()
+    return vocabulary.canonical(str(modality)), text if found else canonical_description(text)
+
+  # mapping and filtering attributes of one raw (Modality, StudyDescription)
+  def lookup(self, modality, description):
+    return pd.read_sql_query("""
+      SELECT m.modality, m.study_description, m.loinc_code, m.long_common_name, a.method, a.system, a.timing, a.midrc_system
+      FROM mappings m LEFT JOIN loinc_attributes a ON a.loinc_code = m.loinc_code
+      WHERE m.modality = ? AND m.study_description = ?""",
+      self.connection, params=self.key(modality, description))
+
+  # contributors that observed one raw (Modality, StudyDescription), with their frequency
+  def contributors(self, modality, description):
+    return pd.read_sql_query("""
+      SELECT contributor, SUM(frequency) AS frequency, GROUP_CONCAT(variants, ' | ') AS variants
+      FROM observations WHERE modality = ? AND study_description = ?
+      GROUP BY contributor ORDER BY frequency DESC""",
+      self.connection, params=self.key(modality, description))
+
+  # observed studies and contributors per LOINC code or per value of one filtering attribute, e.g. L-System
+  def counts(self, attribute):
+    if attribute == "LOINC code":
+      table, column = "m", "loinc_code"
+    elif attribute in ATTRIBUTE_NAMES:
+      table, column = "a", ATTRIBUTE_NAMES[attribute]
+    else:
+      raise ValueError(f"unknown attribute {attribute!r}")
+    return pd.read_sql_query(f"""
+      SELECT {table}.{column} AS value, SUM(o.frequency) AS frequency, COUNT(DISTINCT o.contributor) AS contributors
+      FROM observations o
+      JOIN mappings m ON m.modality = o.modality AND m.study_description = o.study_description
+      LEFT JOIN loinc_attributes a ON a.loinc_code = m.loinc_code
+      GROUP BY {table}.{column} ORDER BY frequency DESC""", self.connection)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Query the harmonization database written by analyze_in_out.py")
+  parser.add_argument("root", help="repository root")
+  parser.add_argument("--cache-dir", default=None, help="directory of the database (default: <root>/.cache)")
+  commands = parser.add_subparsers(dest="command", required=True)
+  for command, help in (("lookup", "LOINC code and attributes of a value"),
+                        ("contributors", "contributors that observed a value")):
+    subparser = commands.add_parser(command, help=help)
+    subparser.add_argument("modality")
+    subparser.add_argument("description")
+  subparser = commands.add_parser("counts", help="observed studies per value of a filtering attribute")
+  subparser.add_argument("attribute", help="LOINC code, L-Method, L-System, Rad.Timing, ...")
+  args = parser.parse_args(argv)
+
+  fileName = database_path(args.cache_dir or os.path.join(args.root, ".cache"))
+  if not os.path.exists(fileName):
+    sys.exit(f"{fileName} not found, run util/analyze_in_out.py --database first")
+
+  database = HarmonizationDatabase(fileName)
+  try:
+    if args.command == "counts":
+      result = database.counts(args.attribute)
+    else:
+      result = getattr(database, args.command)(args.modality, args.description)
+  finally:
+    database.close()
+  print(result.to_string(index=False))
+
+if __name__ == "__main__":
+  main()
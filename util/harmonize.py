@@ -0,0 +1,105 @@
+import pandas as pd
+import numpy as np
+import os
+import sys
+import argparse
+
+from mapping_index import ATTRIBUTE_COLUMNS, load_mapping_index, attributes_path, read_filtering_attributes
+from modality import canonicalize_modalities
+
+# Annotate (Modality, StudyDescription) rows with the LOINC code, long common name and filtering
+# attributes of the mapping table.
+#
+#   from harmonize import harmonize
+#   annotated = harmonize(df, root)
+#
+# Descriptions and modalities are factorized, every distinct pair is looked up once in the
+# compiled mapping index, and the annotations are taken by position for all rows at once.
+
+ANNOTATION_COLUMNS = ["LOINC code", "L-Long Common Name"] + ATTRIBUTE_COLUMNS
+
+class Harmonizer:
+
+  def __init__(self, root=".", cacheDir=None):
+    self.index = load_mapping_index(root, cacheDir)
+
+    rows = self.index.rows[["LOINC code", "L-Long Common Name"]]
+    if os.path.exists(attributes_path(root)):
+      rows = rows.merge(read_filtering_attributes(root), on="LOINC code", how="left")
+    rows = rows.reindex(columns=ANNOTATION_COLUMNS)
+
+    # every annotation is kept as categorical codes per mapping row, plus a trailing -1 (missing)
+    # picked by the -1 position of unmapped keys
+    self.annotations = {}
+    for column in ANNOTATION_COLUMNS:
+      codes, categories = pd.factorize(rows[column])
+      self.annotations[column] = (np.append(codes, -1), pd.Index(categories, dtype=object))
+
+  # position of every row's mapping in self.index.rows, -1 when not mapped
+  def locate(self, df):
+    descriptionCodes, descriptions = pd.factorize(df["StudyDescription"])
+    modalityCodes, modalities = pd.factorize(df["Modality"])
+
+    # missing values point at the trailing NaN category
+    descriptionCodes = np.where(descriptionCodes < 0, len(descriptions), descriptionCodes)
+    modalityCodes = np.where(modalityCodes < 0, len(modalities), modalityCodes)
+
+    # look up each distinct (description, modality) pair once
+    pairCodes, pairs = pd.factorize(descriptionCodes.astype(np.int64) * (len(modalities) + 1) + modalityCodes)
+    pairDescriptions = pairs // (len(modalities) + 1)
+    pairModalities = pairs % (len(modalities) + 1)
+
+    descriptions = self.index.normalize_descriptions(pd.Series(np.append(descriptions.to_numpy(dtype=object), np.nan)))
+    modalities = canonicalize_modalities(pd.Series(np.append(modalities.to_numpy(dtype=object), np.nan)))
+    unique = pd.DataFrame({
+      "StudyDescription": descriptions.to_numpy(dtype=object)[pairDescriptions],
+      "Modality": modalities.to_numpy(dtype=object)[pairModalities],
+    })
+    return self.index.locate(unique)[pairCodes]
+
+  # annotation columns are categoricals, so no string is copied per row
+  def harmonize(self, df):
+    positions = self.locate(df)
+    annotated = df.copy(deep=False)
+    for column, (codes, categories) in self.annotations.items():
+      annotated[column] = pd.Categorical.from_codes(codes[positions], categories)
+    return annotated
+
+def harmonize(df, root=".", cacheDir=None):
+  return Harmonizer(root, cacheDir).harmonize(df)
+
+# annotate a stream of (Modality, StudyDescription) tuples, chunksize rows at a time
+def harmonize_rows(rows, root=".", cacheDir=None, chunksize=100_000):
+  harmonizer = Harmonizer(root, cacheDir)
+  chunk = []
+  for row in rows:
+    chunk.append(row)
+    if len(chunk) == chunksize:
+      yield harmonizer.harmonize(pd.DataFrame(chunk, columns=["Modality", "StudyDescription"]))
+      chunk = []
+  if chunk:
+    yield harmonizer.harmonize(pd.DataFrame(chunk, columns=["Modality", "StudyDescription"]))
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Annotate a study manifest with LOINC codes and filtering attributes")
+  parser.add_argument("root", help="repository root containing out/")
+  parser.add_argument("input", help="CSV or TSV with Modality and StudyDescription columns, - for stdin")
+  parser.add_argument("-o", "--output", default="-", help="annotated CSV, - for stdout (default)")
+  parser.add_argument("--sep", default=None, help="input delimiter (default: tab for .tsv files, comma otherwise)")
+  parser.add_argument("--chunksize", type=int, default=1_000_000, help="rows annotated at a time")
+  parser.add_argument("--cache-dir", default=None,
+                      help="directory of compiled mapping indexes (default: <root>/.cache)")
+  args = parser.parse_args(argv)
+
+  harmonizer = Harmonizer(args.root, args.cache_dir)
+  source = sys.stdin if args.input == "-" else args.input
+  sep = args.sep or ("\t" if args.input.endswith(".tsv") else ",")
+  output = sys.stdout if args.output == "-" else args.output
+
+  header = True
+  for chunk in pd.read_csv(source, sep=sep, chunksize=args.chunksize, dtype={"Modality": object, "StudyDescription": object}):
+    harmonizer.harmonize(chunk).to_csv(output, index=False, header=header, mode="w" if header else "a")
+    header = False
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,137 @@
+import os
+import sys
+import json
+import time
+from contextlib import contextmanager
+
+try:
+  import resource
+except ImportError:
+  # not available on Windows
+  resource = None
+
+# Per-stage wall time, CPU time, peak RSS and row counts of the StudyDescription pipeline.
+#
+#   with stage("normalize", len(df)) as s:
+#     df = normalize_input(df)
+#     s.rowsOut = len(df)
+#
+# Stages of the same name are summed over files and chunks. Worker processes record into their
+# own recorder and hand a snapshot back to the parent, which merges it.
+
+# prefix of the OpenMetrics metric names
+METRIC_PREFIX = "studydescription_stage"
+
+# peak resident set size of this process, None where the platform does not report it
+def peak_rss_bytes():
+  if resource is None:
+    return None
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # kilobytes on Linux, bytes on macOS
+  return peak if sys.platform == "darwin" else peak * 1024
+
+class Stage:
+
+  def __init__(self, rowsIn=None):
+    self.rowsIn = rowsIn
+    self.rowsOut = None
+
+class Recorder:
+
+  def __init__(self):
+    self.stages = {}
+
+  @contextmanager
+  def stage(self, name, rowsIn=None):
+    current = Stage(rowsIn)
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+      yield current
+    finally:
+      self.add(name, {
+        "calls": 1,
+        "wall_seconds": time.perf_counter() - wall,
+        "cpu_seconds": time.process_time() - cpu,
+        "peak_rss_bytes": peak_rss_bytes(),
+        "rows_in": current.rowsIn,
+        "rows_out": current.rowsOut,
+      })
+
+  def add(self, name, record):
+    total = self.stages.get(name)
+    if total is None:
+      self.stages[name] = dict(record)
+      return
+    for key, value in record.items():
+      if value is None:
+        continue
+      if total[key] is None:
+        total[key] = value
+      elif key == "peak_rss_bytes":
+        total[key] = max(total[key], value)
+      else:
+        total[key] += value
+
+  # stages recorded by a worker process
+  def merge(self, stages):
+    for name, record in stages.items():
+      self.add(name, record)
+
+  # the stages recorded so far, clearing the recorder
+  def drain(self):
+    stages, self.stages = self.stages, {}
+    return stages
+
+  def summary(self):
+    peaks = [s["peak_rss_bytes"] for s in self.stages.values() if s["peak_rss_bytes"] is not None]
+    return {
+      "pid": os.getpid(),
+      "wall_seconds": sum(s["wall_seconds"] for s in self.stages.values()),
+      "cpu_seconds": sum(s["cpu_seconds"] for s in self.stages.values()),
+      "peak_rss_bytes": max(peaks) if peaks else None,
+      "stages": self.stages,
+    }
+
+  def write_json(self, fileName):
+    with open(fileName, "w") as f:
+      json.dump(self.summary(), f, indent=2)
+
+  def write_openmetrics(self, fileName):
+    metrics = [
+      ("wall_seconds", "counter", "seconds", "Wall-clock time spent in the stage"),
+      ("cpu_seconds", "counter", "seconds", "CPU time spent in the stage, workers included"),
+      ("peak_rss_bytes", "gauge", "bytes", "Peak resident set size at the end of the stage"),
+      ("rows_in", "counter", None, "Rows entering the stage"),
+      ("rows_out", "counter", None, "Rows leaving the stage"),
+      ("calls", "counter", None, "Times the stage ran, over files and chunks"),
+    ]
+    lines = []
+    for key, kind, unit, description in metrics:
+      name = f"{METRIC_PREFIX}_{key}"
+      lines.append(f"# TYPE {name} {kind}")
+      if unit:
+        lines.append(f"# UNIT {name} {unit}")
+      lines.append(f"# HELP {name} {description}")
+      for stageName, record in self.stages.items():
+        if record[key] is not None:
+          label = stageName.replace("\\", "\\\\").replace('"', '\\"')
+          sample = f"{name}_total" if kind == "counter" else name
+          lines.append(f'{sample}{{stage="{label}"}} {record[key]}')
+    lines.append("# EOF")
+    with open(fileName, "w") as f:
+      f.write("\n".join(lines) + "\n")
+
+  def print_table(self, file=sys.stdout):
+    for name, record in self.stages.items():
+      rowsIn = record["rows_in"] if record["rows_in"] is not None else "-"
+      rowsOut = record["rows_out"] if record["rows_out"] is not None else "-"
+      peak = f"{record['peak_rss_bytes'] / 2**20:8.0f}" if record["peak_rss_bytes"] is not None else f"{'-':>8}"
+      print(f"{name:>20}: {record['wall_seconds']:8.2f} s wall {record['cpu_seconds']:8.2f} s cpu "
+            f"{peak} MB peak {rowsIn:>10} -> {rowsOut}", file=file)
+
+# the recorder of this process
+recorder = Recorder()
+
+def stage(name, rowsIn=None):
+  return recorder.stage(name, rowsIn)
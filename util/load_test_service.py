@@ -0,0 +1,96 @@
+import pandas as pd
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+from urllib.parse import urlencode
+
+# Load test for util/lookup_service.py: keep-alive connections send lookups of descriptions taken
+# from the mapping table and the input files for a fixed time, then throughput and latency are reported.
+
+def sample_keys(root, count, seed=0):
+  frames = [pd.read_csv(os.path.join(root, "out", "StudyDescription_mapping_table.csv"), encoding="utf-8-sig")]
+  inDir = os.path.join(root, "in")
+  for name in sorted(os.listdir(inDir)) if os.path.isdir(inDir) else []:
+    if name.startswith("StudyDescription") and name.endswith((".csv", ".tsv")):
+      frames.append(pd.read_csv(os.path.join(inDir, name), sep="\t" if name.endswith(".tsv") else ","))
+  keys = pd.concat(frames)[["Modality", "StudyDescription"]].dropna().drop_duplicates()
+  keys = list(keys.itertuples(index=False, name=None))
+  random.Random(seed).shuffle(keys)
+  return keys[:count]
+
+async def read_response(reader):
+  length = 0
+  status = int((await reader.readline()).split()[1])
+  while True:
+    line = await reader.readline()
+    if line in (b"\r\n", b""):
+      break
+    name, _, value = line.decode("latin-1").partition(":")
+    if name.lower() == "content-length":
+      length = int(value)
+  await reader.readexactly(length)
+  return status
+
+async def client(host, port, requests, deadline, latencies, errors):
+  reader, writer = await asyncio.open_connection(host, port)
+  i = 0
+  try:
+    while time.perf_counter() < deadline:
+      request = requests[i % len(requests)]
+      i += 1
+      start = time.perf_counter()
+      writer.write(request)
+      await writer.drain()
+      if await read_response(reader) != 200:
+        errors.append(request)
+      latencies.append(time.perf_counter() - start)
+  finally:
+    writer.close()
+
+def build_requests(host, port, keys, batch):
+  requests = []
+  if batch > 1:
+    for i in range(0, len(keys), batch):
+      body = json.dumps([{"Modality": m, "StudyDescription": d} for m, d in keys[i:i + batch]]).encode()
+      head = f"POST /lookup HTTP/1.1\r\nHost: {host}:{port}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n"
+      requests.append(head.encode("latin-1") + body)
+  else:
+    for modality, description in keys:
+      query = urlencode({"modality": modality, "description": description})
+      requests.append(f"GET /lookup?{query} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n".encode("latin-1"))
+  return requests
+
+async def run(args):
+  keys = sample_keys(args.root, args.keys)
+  requests = build_requests(args.host, args.port, keys, args.batch)
+
+  latencies, errors = [], []
+  deadline = time.perf_counter() + args.duration
+  start = time.perf_counter()
+  await asyncio.gather(*(client(args.host, args.port, requests, deadline, latencies, errors) for _ in range(args.connections)))
+  elapsed = time.perf_counter() - start
+
+  latencies.sort()
+  percentile = lambda p: latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000 if latencies else float("nan")
+  print(f"{len(latencies)} requests ({len(latencies) * max(args.batch, 1)} lookups) in {elapsed:.1f} s, {len(errors)} errors")
+  print(f"{len(latencies) / elapsed:.0f} requests/s, {len(latencies) * max(args.batch, 1) / elapsed:.0f} lookups/s")
+  print(f"latency p50 {percentile(0.5):.2f} ms, p99 {percentile(0.99):.2f} ms")
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Load test the local LOINC lookup service")
+  parser.add_argument("root", help="repository root, used to sample lookup keys")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8080)
+  parser.add_argument("--connections", type=int, default=16)
+  parser.add_argument("--duration", type=float, default=10.0, help="seconds")
+  parser.add_argument("--keys", type=int, default=5000, help="distinct keys to cycle through")
+  parser.add_argument("--batch", type=int, default=1, help="lookups per request, POSTed as a batch when > 1")
+  args = parser.parse_args(argv)
+
+  asyncio.run(run(args))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import asyncio
+import argparse
+from functools import lru_cache
+from urllib.parse import urlsplit, parse_qs
+
+from mapping_index import load_mapping_index, mapping_table_path, attributes_path, read_filtering_attributes
+from normalization import normalize_value
+from modality import vocabulary
+
+# Local HTTP service turning (Modality, StudyDescription) into the LOINC code, long common name
+# and filtering attributes of the mapping table.
+#
+#   GET  /lookup?modality=CT&description=CT%20CHEST%20WO   single lookup
+#   POST /lookup   [{"Modality": ..., "StudyDescription": ...}, ...]   batch lookup
+#   GET  /health   digest and size of the loaded index
+#
+# The lookup table is rebuilt in a worker thread when out/ changes and swapped in with a single
+# assignment, so requests always see either the old or the new table.
+
+# exact: the exact descriptions the mapping index keeps apart (MappingIndex.exactSpellings); client
+# modalities are canonicalized without growing the shared vocabulary
+@lru_cache(maxsize=1 << 16)
+def normalize_key(modality, description, exact=frozenset()):
+  return normalize_value(description, exact), vocabulary.canonical_readonly(modality)
+
+# batch items are objects whose Modality and StudyDescription, when given, are strings
+def valid_item(item):
+  return isinstance(item, dict) and all(isinstance(item.get(k), (str, type(None))) for k in ("Modality", "StudyDescription"))
+
+class LookupTable:
+
+  def __init__(self, root, cacheDir=None):
+    index = load_mapping_index(root, cacheDir)
+    self.digest = index.digest
+    self.exactSpellings = index.exactSpellings
+
+    rows = index.rows[["StudyDescription", "Modality", "LOINC code", "L-Long Common Name"]]
+    if os.path.exists(attributes_path(root)):
+      rows = rows.merge(read_filtering_attributes(root), on="LOINC code", how="left")
+    rows = rows.astype(object).where(rows.notna(), None)
+
+    self.entries = {}
+    for record in rows.to_dict("records"):
+      key = (record.pop("StudyDescription"), record.pop("Modality"))
+      self.entries[key] = record
+
+  def __len__(self):
+    return len(self.entries)
+
+  def lookup(self, modality, description):
+    if modality is None or description is None:
+      return None
+    return self.entries.get(normalize_key(modality, description, self.exactSpellings))
+
+class LookupService:
+
+  def __init__(self, root, cacheDir=None, reloadInterval=2.0):
+    self.root = root
+    self.cacheDir = cacheDir
+    self.reloadInterval = reloadInterval
+    self.table = LookupTable(root, cacheDir)
+    self.stamp = self.source_stamp()
+
+  # size and mtime of the tables the lookup is built from
+  def source_stamp(self):
+    stamp = []
+    for fileName in (mapping_table_path(self.root), attributes_path(self.root)):
+      try:
+        st = os.stat(fileName)
+        stamp.append((st.st_size, st.st_mtime_ns))
+      except OSError:
+        stamp.append(None)
+    return tuple(stamp)
+
+  async def watch(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      await asyncio.sleep(self.reloadInterval)
+      stamp = self.source_stamp()
+      if stamp == self.stamp:
+        continue
+      try:
+        table = await loop.run_in_executor(None, LookupTable, self.root, self.cacheDir)
+      except Exception as e:
+        # keep serving the previous table, and retry once the files change again
+        print(f"Reload failed, keeping the previous index: {e}", file=sys.stderr)
+      else:
+        self.table = table
+        print(f"Reloaded {len(table)} mappings ({table.digest})", file=sys.stderr)
+      self.stamp = stamp
+
+  def lookup(self, modality, description):
+    result = {"Modality": modality, "StudyDescription": description}
+    match = self.table.lookup(modality, description)
+    result["mapped"] = match is not None
+    if match is not None:
+      result.update(match)
+    return result
+
+  def handle(self, method, target, body):
+    url = urlsplit(target)
+    if url.path == "/health" and method == "GET":
+      return 200, {"digest": self.table.digest, "mappings": len(self.table)}
+
+    if url.path == "/lookup" and method == "GET":
+      query = parse_qs(url.query)
+      modality = query.get("modality", [None])[0]
+      description = query.get("description", [None])[0]
+      if modality is None or description is None:
+        return 400, {"error": "modality and description are required"}
+      return 200, self.lookup(modality, description)
+
+    if url.path == "/lookup" and method == "POST":
+      try:
+        items = json.loads(body or b"null")
+      except ValueError:
+        return 400, {"error": "request body is not valid JSON"}
+      if not isinstance(items, list) or not all(map(valid_item, items)):
+        return 400, {"error": "expected a JSON list of {\"Modality\", \"StudyDescription\"} objects with string values"}
+      return 200, [self.lookup(i.get("Modality"), i.get("StudyDescription")) for i in items]
+
+    return 404, {"error": f"no route for {method} {url.path}"}
+
+  async def serve_connection(self, reader, writer):
+    try:
+      while True:
+        requestLine = await reader.readline()
+        if not requestLine:
+          break
+        try:
+          method, target, version = requestLine.decode("latin-1").split()
+        except ValueError:
+          await self.respond(writer, 400, {"error": "malformed request line"}, False)
+          break
+
+        headers = {}
+        while True:
+          line = await reader.readline()
+          if line in (b"\r\n", b"\n", b""):
+            break
+          name, _, value = line.decode("latin-1").partition(":")
+          headers[name.strip().lower()] = value.strip()
+
+        try:
+          length = int(headers.get("content-length", 0) or 0)
+        except ValueError:
+          length = -1
+        if length < 0:
+          await self.respond(writer, 400, {"error": "malformed Content-Length"}, False)
+          break
+        body = await reader.readexactly(length) if length else b""
+
+        keepAlive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+        status, payload = self.handle(method, target, body)
+        await self.respond(writer, status, payload, keepAlive)
+        if not keepAlive:
+          break
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    finally:
+      writer.close()
+
+  async def respond(self, writer, status, payload, keepAlive):
+    reasons = {200: "OK", 400: "Bad Request", 404: "Not Found"}
+    body = json.dumps(payload).encode()
+    head = (
+      f"HTTP/1.1 {status} {reasons.get(status, '')}\r\n"
+      f"Content-Type: application/json\r\n"
+      f"Content-Length: {len(body)}\r\n"
+      f"Connection: {'keep-alive' if keepAlive else 'close'}\r\n\r\n"
+    )
+    writer.write(head.encode("latin-1") + body)
+    await writer.drain()
+
+async def serve(service, host, port):
+  server = await asyncio.start_server(service.serve_connection, host, port)
+  print(f"Serving {len(service.table)} mappings on http://{host}:{port}", file=sys.stderr)
+  async with server:
+    await asyncio.gather(server.serve_forever(), service.watch())
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Serve LOINC lookups of (Modality, StudyDescription) over HTTP")
+  parser.add_argument("root", help="repository root containing out/")
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8080)
+  parser.add_argument("--cache-dir", default=None,
+                      help="directory of compiled mapping indexes (default: <root>/.cache)")
+  parser.add_argument("--reload-interval", type=float, default=2.0,
+                      help="seconds between checks of out/ for changes")
+  args = parser.parse_args(argv)
+
+  service = LookupService(args.root, args.cache_dir, args.reload_interval)
+  try:
+    asyncio.run(serve(service, args.host, args.port))
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,88 @@
+import json
+import os
+import hashlib
+import tempfile
+
+# bump when the layout of the manifest changes
+MANIFEST_VERSION = 4
+
+# The manifest in pending/ records the content hash of the mapping table and of every input file,
+# the normalized mapping keys and exact spellings, and the unmapped rows and coverage counters of each input file, so a run only
+# re-diffs what changed since the previous one.
+
+def manifest_path(root):
+  return os.path.join(root, "pending", "StudyDescription_manifest.json")
+
+def file_digest(fileName):
+  sha = hashlib.sha256()
+  with open(fileName, "rb") as f:
+    for block in iter(lambda: f.read(1 << 20), b""):
+      sha.update(block)
+  return sha.hexdigest()
+
+def read_manifest(root, rules):
+  try:
+    with open(manifest_path(root)) as f:
+      manifest = json.load(f)
+  except (OSError, ValueError):
+    return None
+
+  # a manifest written with other normalization rules cannot be reused
+  if manifest.get("version") != MANIFEST_VERSION or manifest.get("rules") != rules:
+    return None
+  return manifest
+
+def write_manifest(root, manifest):
+  fileName = manifest_path(root)
+  fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(fileName), suffix=".tmp")
+  try:
+    with os.fdopen(fd, "w") as f:
+      json.dump(manifest, f, indent=1, sort_keys=True)
+    os.chmod(tmpName, 0o644)
+    os.replace(tmpName, fileName)
+  except BaseException:
+    os.unlink(tmpName)
+    raise
+
+def new_manifest(rules, mappingDigest, mappingKeys, exactSpellings=()):
+  return {
+    "version": MANIFEST_VERSION,
+    "rules": rules,
+    "mapping": {"sha256": mappingDigest, "keys": sorted_keys(mappingKeys), "exact": sorted(exactSpellings)},
+    "inputs": {},
+  }
+
+# JSON has no tuples and no NaN keys worth sorting, so keys are stored as sorted [description, modality] lists
+def sorted_keys(keys):
+  return sorted(([d, m] for d, m in keys), key=lambda k: (str(k[0]), str(k[1])))
+
+def is_up_to_date(manifest, mappingDigest, inputDigests):
+  if manifest is None or manifest["mapping"]["sha256"] != mappingDigest:
+    return False
+  recorded = {name: entry["sha256"] for name, entry in manifest["inputs"].items()}
+  return recorded == inputDigests
+
+# decide what to do with every input file:
+#   "reuse"   - neither the file nor the mapping table changed, keep the cached unmapped rows
+#   "recheck" - only mapping rows were added, test the cached unmapped rows against the new index
+#   "diff"    - the file is new or changed, mapping rows were removed or the exact spellings kept
+#               apart changed (the cached keys were normalized with others): diff the whole file
+def plan_rediff(manifest, mappingDigest, mappingKeys, inputDigests, exactSpellings=()):
+  plan = {name: "diff" for name in inputDigests}
+  if manifest is None:
+    return plan
+
+  if manifest["mapping"]["sha256"] == mappingDigest:
+    cachedAction = "reuse"
+  else:
+    previousKeys = set(tuple(k) for k in manifest["mapping"]["keys"])
+    currentKeys = set(tuple(k) for k in sorted_keys(mappingKeys))
+    if not previousKeys <= currentKeys or manifest["mapping"]["exact"] != sorted(exactSpellings):
+      return plan
+    cachedAction = "recheck"
+
+  for name, digest in inputDigests.items():
+    entry = manifest["inputs"].get(name)
+    if entry is not None and entry["sha256"] == digest:
+      plan[name] = cachedAction
+  return plan
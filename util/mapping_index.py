@@ -0,0 +1,247 @@
+import pandas as pd
+import numpy as np
+import os
+import pickle
+import tempfile
+
+from normalization import NORMALIZATION_VERSION, normalize_study_description, normalize_value, exact_description, canonical_description
+from manifest import file_digest
+from instrumentation import stage
+from modality import explode_modalities
+
+KEY_COLUMNS = ["StudyDescription", "Modality"]
+
+# bump when the layout of MappingIndex changes, so cached indexes are rebuilt
+INDEX_FORMAT_VERSION = 4
+
+# interned strings of one key column, coded as int32
+#
+# The first codes are the values of the mapping table, in the order of the MappingIndex codes, so
+# a code below `mapped` can be looked up in the index directly; values only seen in the inputs get
+# the following codes. Missing values are coded -1.
+class KeyVocabulary:
+
+  def __init__(self, values):
+    self.values = pd.Index(values, dtype=object)
+    self.mapped = len(self.values)
+    self.extra = {}
+    self.extraValues = []
+
+  def __len__(self):
+    return self.mapped + len(self.extraValues)
+
+  # codes of distinct values
+  def encode_unique(self, uniques):
+    uniques = np.asarray(uniques, dtype=object)
+    codes = self.values.get_indexer(uniques).astype(np.int32)
+    for i in np.flatnonzero(codes < 0):
+      value = uniques[i]
+      if not isinstance(value, str):
+        continue
+      code = self.extra.get(value)
+      if code is None:
+        code = self.extra[value] = len(self)
+        self.extraValues.append(value)
+      codes[i] = code
+    return codes
+
+  # int32 codes of a Series; every distinct raw value is passed once through normalize (a function
+  # of a Series) before being interned
+  def encode(self, values, normalize=None):
+    valueCodes, uniques = pd.factorize(values)
+    uniques = pd.Series(uniques.to_numpy(dtype=object))
+    if normalize is not None:
+      uniques = normalize(uniques)
+    # code -1 (missing) picks the trailing -1
+    codes = np.append(self.encode_unique(uniques.to_numpy(dtype=object)), np.int32(-1))
+    return codes[valueCodes]
+
+  def decode(self, codes):
+    strings = np.empty(len(self) + 1, dtype=object)
+    strings[:self.mapped] = self.values.to_numpy(dtype=object)
+    strings[self.mapped:-1] = self.extraValues
+    strings[-1] = np.nan
+    # code -1 picks the trailing NaN
+    return strings[np.asarray(codes, dtype=np.intp)]
+
+# positions of values in categories, -1 when missing or not found; each distinct value is looked
+# up once and the result mapped back through the factorized codes
+def category_codes(values, categories):
+  valueCodes, uniques = pd.factorize(values)
+  # code -1 (missing) picks the trailing -1
+  codes = np.append(categories.get_indexer(np.asarray(uniques, dtype=object)), -1)
+  return codes[valueCodes]
+
+# hash index over the normalized (StudyDescription, Modality) keys of the exploded mapping table
+#
+# Each key column is coded against the categories seen in the mapping table, and the pair of
+# codes is folded into one int64 key, so a lookup hashes every input string once and never
+# builds a joined frame.
+#
+# Canonical words may merge descriptions that the curators mapped to different LOINC codes (CHEST AP
+# PORT and CHEST AP PORTABLE). The exact descriptions of such keys are kept apart: their rows are
+# also indexed under the exact description, and inputs spelled exactly that way are keyed by it
+# (see normalize_descriptions). Other spellings fall back to the canonical key, which goes to the
+# row spelled like the key itself, or else to the first row.
+class MappingIndex:
+
+  def __init__(self, out_df):
+    # SHA-256 of the mapping table this index was compiled from, when known
+    self.digest = None
+
+    exact = out_df["ExactStudyDescription"] if "ExactStudyDescription" in out_df.columns else out_df["StudyDescription"]
+    out_df = out_df.drop(columns="ExactStudyDescription", errors="ignore")
+    conflicting = (out_df.groupby(KEY_COLUMNS)["LOINC code"].transform("nunique") > 1).to_numpy()
+    self.exactSpellings = frozenset(exact[conflicting].dropna())
+
+    # one row per canonical key (first mapping wins, but for the row spelled like a conflicting key)
+    preferred = conflicting & (exact == out_df["StudyDescription"]).to_numpy()
+    canonical = out_df.iloc[np.argsort(~preferred, kind="stable")].drop_duplicates(subset=KEY_COLUMNS)
+    rows = [canonical]
+    if self.exactSpellings:
+      spelled = exact.isin(self.exactSpellings).to_numpy()
+      # exact descriptions of the modalities only mapped under another spelling go to their canonical key
+      fallback = pd.DataFrame({"ExactStudyDescription": sorted(self.exactSpellings)})
+      fallback["StudyDescription"] = [canonical_description(e) for e in fallback["ExactStudyDescription"]]
+      fallback = fallback.merge(canonical, on="StudyDescription")
+      fallback["StudyDescription"] = fallback.pop("ExactStudyDescription")
+      rows = [out_df[spelled].assign(StudyDescription=exact[spelled]), fallback] + rows
+
+    # one row per key, kept for lookups of the mapped values
+    out_df = pd.concat(rows).drop_duplicates(subset=KEY_COLUMNS).reset_index(drop=True)
+    self.rows = out_df
+
+    self.keys = frozenset(zip(out_df["StudyDescription"], out_df["Modality"]))
+
+    descriptionCodes, self._descriptions = pd.factorize(out_df["StudyDescription"].to_numpy(dtype=object))
+    modalityCodes, self._modalities = pd.factorize(out_df["Modality"].to_numpy(dtype=object))
+    self._descriptions = pd.Index(self._descriptions, dtype=object)
+    self._modalities = pd.Index(self._modalities, dtype=object)
+
+    self._pairs = pd.Index(self._pair_codes(descriptionCodes, modalityCodes))
+
+    # shared vocabularies the inputs are coded against, so that their keys are compared as integers
+    self.descriptionVocabulary = KeyVocabulary(self._descriptions)
+    self.modalityVocabulary = KeyVocabulary(self._modalities)
+
+  def __len__(self):
+    return len(self.keys)
+
+  def __contains__(self, key):
+    return tuple(key) in self.keys
+
+  # normalized keys of a Series of raw descriptions
+  def normalize_descriptions(self, descriptions):
+    return normalize_study_description(descriptions, self.exactSpellings)
+
+  def normalize_description(self, description):
+    return normalize_value(description, self.exactSpellings)
+
+  def _pair_codes(self, descriptionCodes, modalityCodes):
+    return descriptionCodes.astype(np.int64) * (len(self._modalities) + 1) + modalityCodes
+
+  # position of each row's key in self.rows, -1 when not mapped
+  def locate(self, df):
+    return self.locate_codes(category_codes(df["StudyDescription"], self._descriptions),
+                             category_codes(df["Modality"], self._modalities))
+
+  # the same for keys coded against descriptionVocabulary and modalityVocabulary
+  def locate_codes(self, descriptionCodes, modalityCodes):
+    descriptionCodes = np.asarray(descriptionCodes)
+    modalityCodes = np.asarray(modalityCodes)
+
+    positions = np.full(len(descriptionCodes), -1, dtype=np.intp)
+    known = ((descriptionCodes >= 0) & (descriptionCodes < len(self._descriptions)) &
+             (modalityCodes >= 0) & (modalityCodes < len(self._modalities)))
+    positions[known] = self._pairs.get_indexer(self._pair_codes(descriptionCodes[known], modalityCodes[known]))
+    return positions
+
+  def is_mapped(self, df):
+    return self.locate(df) >= 0
+
+  # anti-join: rows of df whose key is not in the mapping table
+  def unmapped(self, df):
+    return df[~self.is_mapped(df)]
+
+def mapping_table_path(root):
+  return os.path.join(root, "out", "StudyDescription_mapping_table.csv")
+
+def attributes_path(root):
+  return os.path.join(root, "out", "StudyDescription_filtering_attributes.csv")
+
+ATTRIBUTE_COLUMNS = ["L-Method", "L-System", "Rad.Timing", "MIDRC-System"]
+
+# LOINC attributes for filtering, one row per LOINC code
+def read_filtering_attributes(root):
+  attributes = pd.read_csv(attributes_path(root), encoding="utf-8-sig", dtype=str)
+  return attributes.drop_duplicates(subset=["LOINC code"])[["LOINC code"] + ATTRIBUTE_COLUMNS]
+
+# read mapped values of StudyDescription/Modality combinations, one row per Modality
+def read_mapping_table(fileName):
+  with stage("read mapping") as s:
+    out_df = pd.read_csv(fileName, encoding="utf-8-sig")
+    s.rowsOut = len(out_df)
+
+  with stage("explode Modality", len(out_df)) as s:
+    # one row per modality of lists such as "CR, DX", with canonical codes
+    out_df = explode_modalities(out_df)
+    s.rowsOut = len(out_df)
+
+  with stage("normalize", len(out_df)) as s:
+    # the exact descriptions are kept for keys that canonical words would merge (see MappingIndex)
+    out_df["ExactStudyDescription"] = out_df["StudyDescription"].map(exact_description, na_action="ignore")
+    out_df["StudyDescription"] = normalize_study_description(out_df["StudyDescription"])
+
+    # some codes carry stray whitespace (e.g. a leading tab)
+    out_df["LOINC code"] = out_df["LOINC code"].str.strip()
+    s.rowsOut = len(out_df)
+
+  return out_df
+
+# compiled indexes are named after the mapping table content and the rules used to build them
+def cache_file_name(cacheDir, digest):
+  version = f"n{NORMALIZATION_VERSION}-f{INDEX_FORMAT_VERSION}-pd{pd.__version__}"
+  return os.path.join(cacheDir, f"StudyDescription_mapping_index-{digest}-{version}.pickle")
+
+def write_index(index, fileName):
+  os.makedirs(os.path.dirname(fileName), exist_ok=True)
+
+  # write to a temporary file and rename, so readers never see a partial index
+  fd, tmpName = tempfile.mkstemp(dir=os.path.dirname(fileName), suffix=".tmp")
+  try:
+    with os.fdopen(fd, "wb") as f:
+      pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpName, fileName)
+  except BaseException:
+    os.unlink(tmpName)
+    raise
+
+def read_index(fileName):
+  try:
+    with open(fileName, "rb") as f:
+      index = pickle.load(f)
+  except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+    return None
+  return index if isinstance(index, MappingIndex) else None
+
+# load the compiled index of the mapping table, building and caching it when the table,
+# the normalization rules or the index layout changed since the last run
+def load_mapping_index(root, cacheDir=None, digest=None):
+  fileName = mapping_table_path(root)
+  digest = digest or file_digest(fileName)
+  cacheName = cache_file_name(cacheDir or os.path.join(root, ".cache"), digest)
+
+  with stage("read mapping index") as s:
+    index = read_index(cacheName)
+    s.rowsOut = len(index.rows) if index is not None else None
+  if index is None:
+    out_df = read_mapping_table(fileName)
+    with stage("build mapping index", len(out_df)) as s:
+      index = MappingIndex(out_df)
+      s.rowsOut = len(index.rows)
+    index.digest = digest
+    try:
+      write_index(index, cacheName)
+    except OSError as e:
+      print(f"Could not cache the mapping index in {cacheName}: {e}")
+  return index
@@ -0,0 +1,126 @@
+import pandas as pd
+import numpy as np
+import re
+
+# Canonical Modality vocabulary.
+#
+# Modality values come as single DICOM codes (CT), comma lists with or without spaces (CR, DX),
+# Python list literals (['PT','NM']) and the [blank] placeholder. Every distinct raw value is parsed
+# once into a bitmask over an integer-coded vocabulary of the DICOM modality codes; codes outside
+# the standard list (e.g. CTPT) are appended to the vocabulary the first time they are seen.
+#
+# Multi-valued cells of the mapping table are expanded with a vectorized repeat over the number of
+# bits of each row's mask, instead of building a list per row and exploding it.
+
+BLANK = "[blank]"
+
+# DICOM PS3.3 C.7.3.1.1.1 defined terms, with the retired ones still seen in site exports
+DICOM_MODALITIES = (
+  "AR", "ASMT", "AU", "BDUS", "BI", "BMD", "CR", "CT", "CTPROTOCOL", "DG", "DOC", "DX", "ECG", "EPS",
+  "ES", "FID", "GM", "HC", "HD", "IO", "IOL", "IVOCT", "IVUS", "KER", "KO", "LEN", "LS", "M3D", "MG",
+  "MR", "NM", "OAM", "OCT", "OP", "OPM", "OPT", "OPTBSV", "OPTENF", "OPV", "OSS", "OT", "PLAN", "PR",
+  "PT", "PX", "REG", "RESP", "RF", "RG", "RTDOSE", "RTIMAGE", "RTINTENT", "RTPLAN", "RTRAD",
+  "RTRECORD", "RTSEGANN", "RTSTRUCT", "RWV", "SEG", "SM", "SMR", "SR", "SRF", "STAIN", "TEXTUREMAP",
+  "TG", "US", "VA", "XA", "XC",
+  # retired
+  "CD", "DD", "DF", "DM", "DR", "DS", "EC", "FA", "FS", "LP", "MA", "MS", "OPR", "ST", "VF",
+)
+
+# brackets and quotes of list literals, then the separators between codes
+LIST_PUNCTUATION = re.compile(r"[\[\]'\"]")
+SEPARATORS = re.compile(r"[,;\s]+")
+
+class ModalityVocabulary:
+
+  def __init__(self, codes=DICOM_MODALITIES):
+    self.codes = [BLANK] + list(codes)
+    self.positions = {code: i for i, code in enumerate(self.codes)}
+    # raw value -> bitmask, filled once per distinct raw value
+    self.masks = {}
+
+  def __len__(self):
+    return len(self.codes)
+
+  def code(self, name):
+    position = self.positions.get(name)
+    if position is None:
+      position = self.positions[name] = len(self.codes)
+      self.codes.append(name)
+    return position
+
+  def tokens(self, raw):
+    text = str(raw).strip()
+    if text.upper() in ("", BLANK.upper()):
+      return [BLANK]
+    return [t.upper() for t in SEPARATORS.split(LIST_PUNCTUATION.sub(" ", text)) if t]
+
+  # bitmask of the modalities of one raw value, None for missing values
+  def parse(self, raw):
+    if raw in self.masks:
+      return self.masks[raw]
+    if not isinstance(raw, str):
+      mask = None
+    else:
+      mask = 0
+      for token in self.tokens(raw):
+        mask |= 1 << self.code(token)
+    self.masks[raw] = mask
+    return mask
+
+  # vocabulary positions of the bits of a mask, in vocabulary order
+  @staticmethod
+  def members(mask):
+    return [i for i in range(mask.bit_length()) if mask >> i & 1]
+
+  # one comma-separated string of the sorted codes of a raw value, missing values stay missing
+  def canonical(self, raw):
+    mask = self.parse(raw)
+    if mask is None:
+      return np.nan
+    return ",".join(sorted(self.codes[i] for i in self.members(mask)))
+
+  # the same without interning, for values of untrusted clients: codes outside the vocabulary are
+  # kept as plain strings and neither the codes nor the cached masks are touched
+  def canonical_readonly(self, raw):
+    if not isinstance(raw, str):
+      return np.nan
+    return ",".join(sorted(set(self.tokens(raw))))
+
+  # (row positions, vocabulary positions) with one entry per modality of every value; missing values
+  # keep one entry with position -1
+  def expand(self, values):
+    valueCodes, uniques = pd.factorize(values)
+
+    # member positions of every distinct value, flattened, plus a trailing entry for missing values
+    members = [self.members(m) if m is not None else [-1] for m in map(self.parse, uniques)] + [[-1]]
+    counts = np.array([len(m) for m in members], dtype=np.intp)
+    starts = np.cumsum(counts) - counts
+    flat = np.fromiter((i for m in members for i in m), dtype=np.int32, count=int(counts.sum()))
+
+    # code -1 (missing) picks the trailing entry
+    valueCodes = np.where(valueCodes < 0, len(uniques), valueCodes)
+    rowCounts = counts[valueCodes]
+    rows = np.repeat(np.arange(len(valueCodes)), rowCounts)
+    within = np.arange(len(rows)) - np.repeat(np.cumsum(rowCounts) - rowCounts, rowCounts)
+    return rows, flat[np.repeat(starts[valueCodes], rowCounts) + within]
+
+  def names(self, positions):
+    names = np.array(self.codes + [np.nan], dtype=object)
+    # position -1 picks the trailing NaN
+    return names[positions]
+
+# the vocabulary of this process
+vocabulary = ModalityVocabulary()
+
+# one row per modality of every row's Modality cell, with the canonical code as Modality
+def explode_modalities(df):
+  rows, positions = vocabulary.expand(df["Modality"])
+  exploded = df.take(rows)
+  exploded["Modality"] = vocabulary.names(positions)
+  return exploded
+
+# canonical Modality strings of a Series, each distinct value parsed once
+def canonicalize_modalities(modalities):
+  codes, uniques = pd.factorize(modalities)
+  canonical = np.array([vocabulary.canonical(u) for u in uniques] + [np.nan], dtype=object)
+  return pd.Series(canonical[codes], index=modalities.index, name=modalities.name)
@@ -0,0 +1,77 @@
+import pandas as pd
+import numpy as np
+import unicodedata
+import functools
+import re
+
+# normalization rules applied to both sides of the StudyDescription/Modality join;
+# bump NORMALIZATION_VERSION whenever the rules change so compiled indexes are rebuilt
+NORMALIZATION_VERSION = 5
+
+# canonical spelling of the abbreviations and synonyms of the site exports, looked up for whole
+# whitespace-separated tokens first (W/O, X-RAY), then for each of their words (WO, PORT)
+SYNONYMS = {
+  # contrast
+  "W/O": "WITHOUT", "WO": "WITHOUT", "WOUT": "WITHOUT", "W/OUT": "WITHOUT",
+  "W": "WITH", "W/": "WITH",
+  "WWO": "WITH AND WITHOUT", "W/WO": "WITH AND WITHOUT", "W/W/O": "WITH AND WITHOUT", "W+WO": "WITH AND WITHOUT",
+  "W&WO": "WITH AND WITHOUT", "W-WO": "WITH AND WITHOUT", "WO/W": "WITH AND WITHOUT", "WO+W": "WITH AND WITHOUT",
+  "CON": "CONTRAST", "CONT": "CONTRAST", "CONTR": "CONTRAST", "CM": "CONTRAST", "IVCON": "IV CONTRAST",
+  "NONCON": "NON CONTRAST",
+  # views and positioning
+  "VW": "VIEW", "VWS": "VIEWS", "LAT": "LATERAL", "DECUB": "DECUBITUS",
+  "PORT": "PORTABLE", "POR": "PORTABLE", "PORTABL": "PORTABLE",
+  # procedures
+  "X-RAY": "XR", "XRAY": "XR", "CXR": "XR CHEST", "MRI": "MR",
+  "ANGIOGRAPHY": "ANGIO", "ANGIOGRAM": "ANGIO", "CTA": "CT ANGIO", "MRA": "MR ANGIO",
+  "PLCMT": "PLACEMENT", "PLCMNT": "PLACEMENT",
+  # anatomy and laterality
+  "ABD": "ABDOMEN", "PEL": "PELVIS", "PELV": "PELVIS", "BILAT": "BILATERAL", "LT": "LEFT", "RT": "RIGHT",
+}
+
+# words of a token: runs of letters and digits, so punctuation and underscores separate words
+WORDS = re.compile(r"[^\W_]+")
+
+# view counts written as one word, e.g. 1V, 2VW, 1VIEW
+NUMBERED_VIEWS = re.compile(r"(\d+)(?:V|VW|VWS|VIEW|VIEWS)")
+
+def canonical_word(word):
+  match = NUMBERED_VIEWS.fullmatch(word)
+  if match:
+    return match.group(1) + (" VIEW" if match.group(1) == "1" else " VIEWS")
+  return SYNONYMS.get(word, word)
+
+# canonical words of one upper-case token, joined by spaces; tokens repeat a lot across
+# descriptions, so each distinct token is canonicalized once
+@functools.lru_cache(maxsize=1 << 16)
+def canonical_token(token):
+  if token in SYNONYMS:
+    return SYNONYMS[token]
+  return " ".join(canonical_word(w) for w in WORDS.findall(token))
+
+# Unicode compatibility forms folded (NFKC) and capitalized, with whitespace runs as single spaces;
+# this is the key of the descriptions the mapping table keeps apart (see MappingIndex)
+def exact_description(value):
+  return " ".join(unicodedata.normalize("NFKC", str(value)).upper().split())
+
+# the key rebuilt from the canonical words of every whitespace-separated token of an exact description
+def canonical_description(text):
+  tokens = (canonical_token(t) for t in text.split())
+  return " ".join(t for t in tokens if t)
+
+# key of one raw description; exact descriptions found in `exact` are kept, the others canonicalized
+def normalize_value(value, exact=frozenset()):
+  text = exact_description(value)
+  return text if text in exact else canonical_description(text)
+
+# normalize a Series of descriptions; every distinct value is normalized once and the
+# result is mapped back through the factorized codes, missing values stay missing
+def normalize_study_description(descriptions, exact=frozenset()):
+  codes, uniques = pd.factorize(descriptions)
+
+  normalized = np.empty(len(uniques) + 1, dtype=object)
+  normalized[:-1] = [normalize_value(v, exact) for v in uniques]
+  normalized[-1] = np.nan
+
+  # code -1 (missing) picks the trailing NaN
+  return pd.Series(normalized[codes], index=descriptions.index, name=descriptions.name)
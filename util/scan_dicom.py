@@ -0,0 +1,270 @@
+import os
+import sys
+import csv
+import sqlite3
+import argparse
+from collections import Counter
+from multiprocessing import Pool
+
+# Scan a tree of DICOM files and write the StudyDescription counts consumed by analyze_in_out.py,
+# one row per (Modality, StudyDescription) with the number of distinct studies as frequency.
+#
+# Only the Modality, StudyDescription and StudyInstanceUID elements are parsed; reading stops
+# before the pixel data. Requires pydicom.
+#
+# With --ledger, every processed file is recorded in a SQLite ledger (path, size, mtime and the
+# extracted values), committed in batches. A restarted or repeated scan only reads the files that
+# are new or whose size or mtime changed, and the TSV is produced by a GROUP BY over the ledger.
+
+TAGS = ["StudyInstanceUID", "Modality", "StudyDescription"]
+
+# paths are handed to the workers in batches, as the directory walk proceeds
+BATCH_SIZE = 256
+
+# ledger rows written per transaction
+COMMIT_EVERY = 5000
+
+try:
+  import pydicom
+  from pydicom.errors import InvalidDicomError
+except ImportError:
+  pydicom = None
+
+# (directory, [(path, size, mtime_ns), ...], listed) for every directory of the tree; size and
+# mtime are only read when stat is set, and listed is False when the directory could not be listed
+# completely, in which case files holds the entries read before the error
+def walk_directories(top, stat=False):
+  stack = [top]
+  while stack:
+    directory = stack.pop()
+    files = []
+    listed = True
+    try:
+      with os.scandir(directory) as entries:
+        for entry in entries:
+          if entry.is_dir(follow_symlinks=False):
+            stack.append(entry.path)
+          elif entry.is_file(follow_symlinks=False):
+            if stat:
+              st = entry.stat(follow_symlinks=False)
+              files.append((entry.path, st.st_size, st.st_mtime_ns))
+            else:
+              files.append((entry.path, None, None))
+    except OSError as e:
+      print(f"Cannot list {directory}: {e}", file=sys.stderr)
+      listed = False
+    yield directory, files, listed
+
+def walk(top):
+  for _, files, _ in walk_directories(top):
+    yield from files
+
+def batches(paths, size=BATCH_SIZE):
+  batch = []
+  for path in paths:
+    batch.append(path)
+    if len(batch) == size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+def as_text(value):
+  return str(value).strip() if value is not None else ""
+
+# (path, size, mtime_ns, StudyInstanceUID, Modality, StudyDescription), with empty values for
+# files that are not DICOM
+def read_header(item):
+  path, size, mtime = item
+  try:
+    ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=TAGS)
+  except (InvalidDicomError, OSError, ValueError, EOFError):
+    return path, size, mtime, "", "", ""
+  return path, size, mtime, as_text(ds.get("StudyInstanceUID")), as_text(ds.get("Modality")), as_text(ds.get("StudyDescription"))
+
+def read_headers(items):
+  return [read_header(i) for i in items]
+
+def read_all(items, jobs=None):
+  if jobs == 1:
+    for batch in batches(items):
+      yield read_headers(batch)
+    return
+  with Pool(jobs) as pool:
+    yield from pool.imap_unordered(read_headers, batches(items))
+
+# collects the series-level headers of each study
+class StudyCollector:
+
+  def __init__(self):
+    self.modalities = {}
+    self.descriptions = {}
+    self.files = 0
+    self.skipped = 0
+
+  def add(self, studyUID, modality, description):
+    self.files += 1
+    if not studyUID:
+      self.skipped += 1
+      return
+    self.modalities.setdefault(studyUID, set())
+    if modality:
+      self.modalities[studyUID].add(modality)
+    # the same description is kept whatever the order the series are read in
+    if description > self.descriptions.get(studyUID, ""):
+      self.descriptions[studyUID] = description
+
+  # number of studies per (Modality, StudyDescription); a study with series of several modalities
+  # is reported with the comma-separated list of them, as in the site exports
+  def frequencies(self):
+    counts = Counter()
+    for studyUID, modalities in self.modalities.items():
+      counts[(",".join(sorted(modalities)), self.descriptions.get(studyUID, ""))] += 1
+    return counts
+
+def scan(top, jobs=None):
+  collector = StudyCollector()
+  for headers in read_all(walk(top), jobs):
+    for _, _, _, studyUID, modality, description in headers:
+      collector.add(studyUID, modality, description)
+  return collector.frequencies(), collector
+
+class Ledger:
+
+  def __init__(self, fileName):
+    self.fileName = fileName
+    self.connection = sqlite3.connect(fileName)
+    self.connection.execute("PRAGMA journal_mode=WAL")
+    self.connection.execute("PRAGMA synchronous=NORMAL")
+    self.connection.execute("""
+      CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        directory TEXT NOT NULL,
+        size INTEGER,
+        mtime_ns INTEGER,
+        study_uid TEXT,
+        modality TEXT,
+        study_description TEXT
+      )""")
+    self.connection.execute("CREATE INDEX IF NOT EXISTS files_directory ON files (directory)")
+    self.connection.commit()
+    self.uncommitted = 0
+
+  # files of the tree that are not in the ledger yet, or whose size or mtime changed; ledger rows of
+  # files that disappeared from a listed directory are collected in `removed`, and every listed
+  # directory in `visited`. Directories that could not be listed go to `failed` instead, and their
+  # rows are kept. This generator runs in the thread feeding the pool, so it reads through its own
+  # connection.
+  def changed_files(self, top, counts, removed, visited, failed):
+    reader = sqlite3.connect(self.fileName)
+    try:
+      for directory, files, listed in walk_directories(top, stat=True):
+        (visited if listed else failed).add(directory)
+        known = {path: (size, mtime) for path, size, mtime in
+                 reader.execute("SELECT path, size, mtime_ns FROM files WHERE directory = ?", (directory,))}
+        for path, size, mtime in files:
+          if known.pop(path, None) == (size, mtime):
+            counts["unchanged"] += 1
+          else:
+            yield path, size, mtime
+        if listed:
+          removed.extend(known)
+    finally:
+      reader.close()
+
+  def record(self, headers):
+    self.connection.executemany(
+      "INSERT OR REPLACE INTO files (path, directory, size, mtime_ns, study_uid, modality, study_description) "
+      "VALUES (?, ?, ?, ?, ?, ?, ?)",
+      [(path, os.path.dirname(path), size, mtime, uid, modality, description)
+       for path, size, mtime, uid, modality, description in headers])
+    self.uncommitted += len(headers)
+    if self.uncommitted >= COMMIT_EVERY:
+      self.commit()
+
+  def forget(self, paths):
+    self.connection.executemany("DELETE FROM files WHERE path = ?", [(p,) for p in paths])
+
+  # rows of directories under top that were not listed by a complete scan, i.e. were removed; the
+  # subtrees of failed directories, whose subdirectories may just not have been seen, are kept
+  def forget_directories(self, top, visited, failed=()):
+    prefix = os.path.join(top, "")
+    kept = tuple(os.path.join(d, "") for d in failed)
+    gone = [d for (d,) in self.connection.execute("SELECT DISTINCT directory FROM files")
+            if (d == top or d.startswith(prefix)) and d not in visited and d not in failed and not d.startswith(kept)]
+    return self.connection.executemany("DELETE FROM files WHERE directory = ?", [(d,) for d in gone]).rowcount
+
+  def commit(self):
+    self.connection.commit()
+    self.uncommitted = 0
+
+  # studies per (Modality, StudyDescription): series rows are first reduced to one row per study,
+  # with the sorted list of its modalities and its (largest) description, as StudyCollector does
+  def frequencies(self):
+    rows = self.connection.execute("""
+      SELECT Modality, StudyDescription, COUNT(*) AS frequency FROM (
+        SELECT study_uid, COALESCE(group_concat(modality, ','), '') AS Modality,
+               COALESCE(MAX(description), '') AS StudyDescription
+        FROM (
+          SELECT study_uid, NULLIF(modality, '') AS modality, MAX(NULLIF(study_description, '')) AS description
+          FROM files WHERE study_uid != ''
+          GROUP BY study_uid, NULLIF(modality, '')
+          ORDER BY study_uid, modality)
+        GROUP BY study_uid)
+      GROUP BY Modality, StudyDescription""")
+    return Counter({(modality, description): frequency for modality, description, frequency in rows})
+
+  def close(self):
+    self.commit()
+    self.connection.close()
+
+def scan_with_ledger(top, ledgerName, jobs=None):
+  ledger = Ledger(ledgerName)
+  counts = Counter()
+  removed = []
+  visited = set()
+  failed = set()
+  try:
+    for headers in read_all(ledger.changed_files(top, counts, removed, visited, failed), jobs):
+      ledger.record(headers)
+      counts["read"] += len(headers)
+    ledger.forget(removed)
+    counts["removed"] = len(removed) + ledger.forget_directories(top, visited, failed)
+    ledger.commit()
+    return ledger.frequencies(), counts
+  finally:
+    ledger.close()
+
+def write_frequencies(counts, fileName):
+  with open(fileName, "w", newline="") as f:
+    writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+    writer.writerow(["Modality", "StudyDescription", "frequency"])
+    for (modality, description), frequency in sorted(counts.items(), key=lambda c: (-c[1], c[0])):
+      writer.writerow([modality, description, frequency])
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Count StudyDescription values per study in a tree of DICOM files")
+  parser.add_argument("directory", help="top of the DICOM directory tree")
+  parser.add_argument("output", help="TSV to write, e.g. in/StudyDescriptions_<site>.tsv")
+  parser.add_argument("--jobs", type=int, default=None, help="worker processes reading headers")
+  parser.add_argument("--ledger", default=None,
+                      help="SQLite progress ledger, so an interrupted or repeated scan only reads new or changed files")
+  args = parser.parse_args(argv)
+
+  if pydicom is None:
+    sys.exit("scan_dicom.py requires pydicom (pip install pydicom)")
+
+  if args.ledger:
+    counts, progress = scan_with_ledger(args.directory, args.ledger, args.jobs)
+    print(f"{progress['read']} files read, {progress['unchanged']} unchanged files skipped, "
+          f"{progress['removed']} removed files dropped from {args.ledger}")
+  else:
+    counts, collector = scan(args.directory, args.jobs)
+    print(f"{collector.files} files, {len(collector.modalities)} studies, "
+          f"{collector.skipped} files skipped (not DICOM or no StudyInstanceUID)")
+
+  write_frequencies(counts, args.output)
+  print(f"{len(counts)} distinct values written to {args.output}")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,96 @@
+import pandas as pd
+import numpy as np
+from collections import defaultdict
+
+# Suggest mapped StudyDescriptions for unmapped ones.
+#
+# The mapped descriptions of every Modality are indexed by their character trigrams. A pending
+# description only gathers candidates from the posting lists of its own trigrams, skipping the
+# very common ones, and only the best candidates by shared trigram count are scored.
+
+NGRAM = 3
+
+def ngrams(text):
+  padded = f" {text} "
+  return set(padded[i:i + NGRAM] for i in range(len(padded) - NGRAM + 1))
+
+def dice(a, b):
+  return 2.0 * len(a & b) / (len(a) + len(b)) if a or b else 0.0
+
+# mapped descriptions of one Modality and their trigram postings
+class ModalityBucket:
+
+  def __init__(self, rows, maxPosting):
+    self.descriptions = rows["StudyDescription"].tolist()
+    self.codes = rows["LOINC code"].tolist()
+    self.names = rows["L-Long Common Name"].tolist()
+    self.grams = [ngrams(d) for d in self.descriptions]
+    self.tokens = [set(d.split()) for d in self.descriptions]
+
+    postings = defaultdict(list)
+    for i, grams in enumerate(self.grams):
+      for gram in grams:
+        postings[gram].append(i)
+    self.postings = {gram: np.array(ids, dtype=np.int32) for gram, ids in postings.items()}
+
+    # trigrams shared by a large part of the bucket do not discriminate and only cost time
+    self.maxPosting = max(maxPosting, 1)
+
+  def candidates(self, grams, limit):
+    # rarest trigrams first, stopping once the postings budget is spent (but always using one list)
+    # (trigrams are taken in sorted order, so ties in length do not depend on set iteration order)
+    lists = sorted((self.postings[g] for g in sorted(grams) if g in self.postings), key=len)
+    budget = 4 * self.maxPosting
+    used = 0
+    for i, posting in enumerate(lists):
+      used += len(posting)
+      if used > budget and i > 0:
+        lists = lists[:i]
+        break
+    if not lists:
+      return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64)
+
+    ids, shared = np.unique(np.concatenate(lists), return_counts=True)
+    if len(ids) > limit:
+      keep = np.argpartition(-shared, limit - 1)[:limit]
+      ids, shared = ids[keep], shared[keep]
+    return ids, shared
+
+class SuggestionIndex:
+
+  # rows: normalized mapped rows with StudyDescription, Modality, LOINC code and L-Long Common Name
+  def __init__(self, rows, maxPostingFraction=0.2, maxPosting=1000):
+    rows = rows.dropna(subset=["StudyDescription", "Modality"])
+    rows = rows.drop_duplicates(subset=["StudyDescription", "Modality"])
+    self.buckets = {}
+    for modality, group in rows.groupby("Modality", sort=False):
+      limit = min(maxPosting, int(len(group) * maxPostingFraction))
+      self.buckets[modality] = ModalityBucket(group, limit)
+
+  # top-k mapped rows for one description as (score, StudyDescription, LOINC code, L-Long Common Name), best first
+  def suggest(self, description, modality, k=3, candidates=20):
+    bucket = self.buckets.get(modality)
+    if bucket is None or not isinstance(description, str):
+      return []
+
+    grams = ngrams(description)
+    tokens = set(description.split())
+    ids, shared = bucket.candidates(grams, candidates)
+
+    # trigram and token-set Dice, averaged; the shared counts above only cover the rare trigrams
+    scored = []
+    for i in ids.tolist():
+      score = (dice(grams, bucket.grams[i]) + dice(tokens, bucket.tokens[i])) / 2
+      scored.append((score, i))
+    scored.sort(key=lambda s: (-s[0], s[1]))
+    return [(score, bucket.descriptions[i], bucket.codes[i], bucket.names[i]) for score, i in scored[:k]]
+
+# one row per (pending row, suggestion rank) for the distinct pending keys
+def suggest_for(diff_df, index, k=3):
+  records = []
+  keys = diff_df[["StudyDescription", "Modality"]].drop_duplicates()
+  for description, modality in keys.itertuples(index=False):
+    for rank, (score, suggested, code, name) in enumerate(index.suggest(description, modality, k), start=1):
+      records.append((description, modality, rank, suggested, code, name, round(score, 3)))
+  columns = ["StudyDescription", "Modality", "Rank", "SuggestedStudyDescription", "LOINC code", "L-Long Common Name", "Score"]
+  return pd.DataFrame.from_records(records, columns=columns)
@@ -0,0 +1,223 @@
+import os
+import re
+import sys
+import json
+import zipfile
+import argparse
+import posixpath
+import xml.etree.ElementTree as ET
+
+from mapping_index import load_mapping_index, mapping_table_path, attributes_path
+from manifest import file_digest
+
+# Regenerate the CSV tables of out/ from out/mapping_table.xlsx.
+#
+# The sheet XML is streamed with an iterative parser, row by row, and string cells are resolved
+# through the shared-strings table, so the workbook is never loaded as a DOM or cell by cell. The
+# CSV files are written the way Excel exports "CSV UTF-8" (BOM, CRLF, no newline after the last
+# row), so an unchanged sheet gives an unchanged file. The mapping index is compiled into the cache
+# right after, and nothing is done when the workbook and the CSV files are as the last sync left them.
+
+# worksheet name -> CSV it is exported to
+SHEETS = {
+  "MIDRC-LOINC Mapping Table": mapping_table_path,
+  "LOINC attributes for filtering": attributes_path,
+}
+
+MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PACKAGE_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+# characters Excel escapes in strings, e.g. _x000D_
+ESCAPED = re.compile(r"_x([0-9A-Fa-f]{4})_")
+
+def workbook_path(root):
+  return os.path.join(root, "out", "mapping_table.xlsx")
+
+def stamp_path(cacheDir):
+  return os.path.join(cacheDir, "mapping_table.xlsx.json")
+
+def unescape(text):
+  return ESCAPED.sub(lambda m: chr(int(m.group(1), 16)), text)
+
+# text of a shared or inline string: its <t> elements, including rich text runs but not phonetic hints
+def string_text(element):
+  parts = []
+  for child in element:
+    if child.tag == MAIN_NS + "t":
+      parts.append(child.text or "")
+    elif child.tag == MAIN_NS + "r":
+      parts.extend(t.text or "" for t in child.iter(MAIN_NS + "t"))
+  return unescape("".join(parts))
+
+def read_shared_strings(archive):
+  try:
+    f = archive.open("xl/sharedStrings.xml")
+  except KeyError:
+    return []
+  strings = []
+  with f:
+    for _, element in ET.iterparse(f):
+      if element.tag == MAIN_NS + "si":
+        strings.append(string_text(element))
+        element.clear()
+  return strings
+
+# sheet name -> path of its XML part in the archive
+def sheet_parts(archive):
+  with archive.open("xl/_rels/workbook.xml.rels") as f:
+    targets = {r.get("Id"): r.get("Target") for r in ET.parse(f).getroot().iter(PACKAGE_REL_NS + "Relationship")}
+  with archive.open("xl/workbook.xml") as f:
+    sheets = ET.parse(f).getroot().iter(MAIN_NS + "sheet")
+    parts = {}
+    for sheet in sheets:
+      target = targets[sheet.get(REL_NS + "id")]
+      parts[sheet.get("name")] = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+  return parts
+
+def column_index(reference):
+  index = 0
+  for char in reference:
+    if not char.isalpha():
+      break
+    index = index * 26 + ord(char.upper()) - ord("A") + 1
+  return index - 1
+
+def cell_value(cell, strings):
+  kind = cell.get("t", "n")
+  if kind == "inlineStr":
+    inline = cell.find(MAIN_NS + "is")
+    return string_text(inline) if inline is not None else ""
+  value = cell.find(MAIN_NS + "v")
+  text = value.text if value is not None and value.text is not None else ""
+  if kind == "s":
+    return strings[int(text)] if text else ""
+  if kind == "b":
+    return "TRUE" if text == "1" else "FALSE"
+  if kind == "str":
+    return unescape(text)
+  return text
+
+# rows of one sheet as lists of strings, with empty cells filled in
+def iter_rows(archive, part, strings):
+  with archive.open(part) as f:
+    sheetData = None
+    for event, element in ET.iterparse(f, events=("start", "end")):
+      if event == "start":
+        if element.tag == MAIN_NS + "sheetData":
+          sheetData = element
+        continue
+      if element.tag != MAIN_NS + "row":
+        continue
+      values = []
+      for cell in element.iter(MAIN_NS + "c"):
+        reference = cell.get("r")
+        position = column_index(reference) if reference else len(values)
+        values.extend([""] * (position - len(values)))
+        values.append(cell_value(cell, strings))
+      yield values
+      # drop the parsed rows, so memory stays bounded by one row
+      if sheetData is not None:
+        sheetData.clear()
+
+# Excel quotes fields with separators, quotes, line breaks or tabs (e.g. the stray tab of some
+# LOINC codes), but not fields with leading or trailing spaces
+def excel_field(value):
+  if any(c in value for c in ",\"\r\n\t"):
+    return '"' + value.replace('"', '""') + '"'
+  return value
+
+def excel_row(values):
+  return ",".join(excel_field(v) for v in values)
+
+# CSV text as Excel exports it: header width, no trailing empty rows, CRLF between rows
+def sheet_csv(rows):
+  rows = iter(rows)
+  header = next(rows, [])
+  while header and not header[-1]:
+    header.pop()
+  width = len(header)
+
+  lines = [excel_row(header)]
+  pending = 0
+  for values in rows:
+    values = (values + [""] * width)[:width]
+    if not any(values):
+      pending += 1
+      continue
+    # empty rows inside the table are kept, trailing ones dropped
+    lines.extend([excel_row([""] * width)] * pending)
+    pending = 0
+    lines.append(excel_row(values))
+  return "\r\n".join(lines)
+
+def write_text(fileName, text):
+  tmpName = fileName + ".tmp"
+  with open(tmpName, "w", encoding="utf-8-sig", newline="") as f:
+    f.write(text)
+  os.replace(tmpName, fileName)
+
+def read_stamp(cacheDir):
+  try:
+    with open(stamp_path(cacheDir)) as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return None
+
+def write_stamp(cacheDir, stamp):
+  os.makedirs(cacheDir, exist_ok=True)
+  with open(stamp_path(cacheDir), "w") as f:
+    json.dump(stamp, f, indent=2)
+
+def output_digests(fileNames):
+  return {f: file_digest(f) if os.path.exists(f) else None for f in fileNames}
+
+# export the sheets of the workbook and compile the mapping index; returns False when the workbook
+# and its CSV files were already in sync
+def sync(root, cacheDir=None, force=False):
+  cacheDir = cacheDir or os.path.join(root, ".cache")
+  workbook = workbook_path(root)
+  workbookDigest = file_digest(workbook)
+  fileNames = [path(root) for path in SHEETS.values()]
+
+  stamp = read_stamp(cacheDir)
+  if (not force and stamp and stamp.get("workbook") == workbookDigest and
+      stamp.get("outputs") == {os.path.relpath(f, root): d for f, d in output_digests(fileNames).items()}):
+    return False
+
+  with zipfile.ZipFile(workbook) as archive:
+    strings = read_shared_strings(archive)
+    parts = sheet_parts(archive)
+    for sheet, path in SHEETS.items():
+      if sheet not in parts:
+        raise KeyError(f"{workbook} has no sheet named {sheet!r}")
+      write_text(path(root), sheet_csv(iter_rows(archive, parts[sheet], strings)))
+
+  index = load_mapping_index(root, cacheDir)
+  print(f"Compiled the mapping index of {len(index)} keys ({index.digest})")
+
+  write_stamp(cacheDir, {
+    "workbook": workbookDigest,
+    "outputs": {os.path.relpath(f, root): d for f, d in output_digests(fileNames).items()},
+  })
+  return True
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Export the sheets of out/mapping_table.xlsx to the CSV tables of out/")
+  parser.add_argument("root", help="repository root containing out/")
+  parser.add_argument("--cache-dir", default=None,
+                      help="directory of compiled mapping indexes and of the sync stamp (default: <root>/.cache)")
+  parser.add_argument("--force", action="store_true", help="export even when the workbook did not change")
+  args = parser.parse_args(argv)
+
+  if not os.path.exists(workbook_path(args.root)):
+    sys.exit(f"{workbook_path(args.root)} not found")
+
+  if sync(args.root, args.cache_dir, args.force):
+    for path in SHEETS.values():
+      print(f"Wrote {path(args.root)}")
+  else:
+    print("Workbook unchanged since the last sync, nothing to do")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,152 @@
+import pandas as pd
+import numpy as np
+import os
+import shutil
+import argparse
+
+from mapping_index import mapping_table_path, attributes_path
+
+# Synthetic workloads for analyze_in_out.py at archive scale.
+#
+# A workload is a repository root with out/StudyDescription_mapping_table.csv (the real table,
+# optionally grown with synthetic rows) and in/StudyDescriptions_Synthetic.tsv. Input rows draw
+# their (Modality, StudyDescription) from a Zipf distribution over a vocabulary of mapped and
+# unmapped descriptions, each seen under a few noisy spellings: extra whitespace, lower or mixed
+# case, punctuation and the abbreviations of the site exports (WO, 1V, PORT, ...). Frequencies are
+# Zipf distributed as well.
+#
+#   python util/synthetic_workload.py /tmp/workload --rows 10000000 --mapping-rows 100000
+
+# the repository this script belongs to, whose out/ tables are the base of a workload
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BODY_PARTS = ["CHEST", "ABDOMEN", "PELVIS", "HEAD", "NECK", "BRAIN", "SPINE", "KNEE", "SHOULDER", "HIP",
+              "ANKLE", "WRIST", "HAND", "FOOT", "ELBOW", "SINUS", "ORBIT", "HEART", "AORTA", "LIVER"]
+QUALIFIERS = ["", "WITHOUT CONTRAST", "WITH CONTRAST", "WITH AND WITHOUT CONTRAST", "1 VIEW", "2 VIEWS",
+              "PORTABLE", "ANGIO", "LEFT", "RIGHT", "BILATERAL", "LOW DOSE", "HIGH RESOLUTION"]
+MODALITIES = ["CT", "CR", "DX", "MR", "US", "NM", "PT", "RF", "MG", "XA"]
+
+ABBREVIATIONS = [("WITHOUT", "WO"), ("WITHOUT", "W/O"), ("WITH", "W"), ("WITH", "W/"), ("VIEWS", "VWS"),
+                 ("VIEW", "V"), ("VIEW", "VW"), ("PORTABLE", "PORT"), ("CONTRAST", "CON"),
+                 ("ABDOMEN", "ABD"), ("PELVIS", "PELV"), ("BILATERAL", "BILAT")]
+
+# one noisy spelling of a description
+def add_noise(description, rng):
+  words = description.split()
+  kind = rng.integers(0, 4)
+  if kind == 0:
+    # whitespace
+    text = "  ".join(words) if rng.random() < 0.5 else " " + " ".join(words) + " "
+  elif kind == 1:
+    # case
+    text = " ".join(words).lower() if rng.random() < 0.5 else " ".join(words).title()
+  elif kind == 2:
+    # punctuation
+    separator = [", ", "-", "_", " / "][rng.integers(0, 4)]
+    text = separator.join(words) if len(words) > 1 else words[0] + "."
+  else:
+    # abbreviation of the first abbreviable word
+    text = " ".join(words)
+    for word, abbreviation in ABBREVIATIONS:
+      if word in words:
+        text = " ".join(abbreviation if w == word else w for w in words)
+        break
+  return text
+
+def synthetic_descriptions(count, rng, start=0):
+  parts = rng.integers(0, len(BODY_PARTS), count)
+  qualifiers = rng.integers(0, len(QUALIFIERS), count)
+  return [" ".join(filter(None, (BODY_PARTS[p], QUALIFIERS[q], f"PROTOCOL {start + i}")))
+          for i, (p, q) in enumerate(zip(parts, qualifiers))]
+
+# the real mapping table grown to `rows` rows with synthetic descriptions mapped to real LOINC codes
+def scale_mapping_table(mapping, rows, rng):
+  if rows <= len(mapping):
+    return mapping
+  extra = rows - len(mapping)
+  codes = mapping[["LOINC code", "L-Long Common Name"]].drop_duplicates().reset_index(drop=True)
+  picked = codes.iloc[rng.integers(0, len(codes), extra)].reset_index(drop=True)
+  synthetic = pd.DataFrame({
+    "Modality": np.array(MODALITIES, dtype=object)[rng.integers(0, len(MODALITIES), extra)],
+    "StudyDescription": synthetic_descriptions(extra, rng),
+    "LOINC code": picked["LOINC code"],
+    "L-Long Common Name": picked["L-Long Common Name"],
+  })
+  return pd.concat([mapping, synthetic[mapping.columns]], ignore_index=True)
+
+# (Modality, spelling) vocabulary of the input: every mapped description plus `unmapped` new ones,
+# each with `variants` spellings of which the first is the clean one; ordered by Zipf rank, so
+# mapped and unmapped values are mixed among the frequent ones
+def input_vocabulary(mapping, unmapped, variants, rng):
+  mapped = mapping[["Modality", "StudyDescription"]].dropna()
+  mapped = mapped.assign(Modality=mapped["Modality"].str.split(",")).explode("Modality")
+  mapped["Modality"] = mapped["Modality"].str.strip()
+  base = pd.concat([mapped, pd.DataFrame({
+    "Modality": np.array(MODALITIES, dtype=object)[rng.integers(0, len(MODALITIES), unmapped)],
+    "StudyDescription": synthetic_descriptions(unmapped, rng, start=len(mapping)),
+  })], ignore_index=True)
+  base = base.iloc[rng.permutation(len(base))]
+
+  modalities, descriptions = [], []
+  for modality, description in zip(base["Modality"], base["StudyDescription"]):
+    modalities.append(modality)
+    descriptions.append(description)
+    for _ in range(variants - 1):
+      modalities.append(modality)
+      descriptions.append(add_noise(description, rng))
+  return np.array(modalities, dtype=object), np.array(descriptions, dtype=object)
+
+# Zipf-distributed ranks in [0, size)
+def zipf_ranks(size, count, exponent, rng):
+  return (rng.zipf(exponent, count) - 1) % size
+
+def write_input(fileName, modalities, descriptions, rows, rng, exponent=1.2, chunksize=1_000_000):
+  header = True
+  for start in range(0, rows, chunksize):
+    count = min(chunksize, rows - start)
+    picked = zipf_ranks(len(descriptions), count, exponent, rng)
+    pd.DataFrame({
+      "Modality": modalities[picked],
+      "StudyDescription": descriptions[picked],
+      "frequency": np.minimum(rng.zipf(1.5, count), 50_000),
+    }).to_csv(fileName, sep="\t", index=False, header=header, mode="w" if header else "a")
+    header = False
+
+def generate(root, rows, mappingRows=None, unmapped=None, variants=4, seed=0, source=REPOSITORY_ROOT):
+  rng = np.random.default_rng(seed)
+  os.makedirs(os.path.join(root, "in"), exist_ok=True)
+  os.makedirs(os.path.join(root, "out"), exist_ok=True)
+  os.makedirs(os.path.join(root, "pending"), exist_ok=True)
+
+  mapping = pd.read_csv(mapping_table_path(source), encoding="utf-8-sig", dtype=str)
+  mapping = scale_mapping_table(mapping, mappingRows or len(mapping), rng)
+  mapping.to_csv(mapping_table_path(root), index=False, encoding="utf-8-sig")
+  if os.path.exists(attributes_path(source)):
+    shutil.copyfile(attributes_path(source), attributes_path(root))
+
+  if unmapped is None:
+    unmapped = max(len(mapping) // 4, min(rows // 50, 1_000_000))
+  modalities, descriptions = input_vocabulary(mapping, unmapped, variants, rng)
+  fileName = os.path.join(root, "in", "StudyDescriptions_Synthetic.tsv")
+  write_input(fileName, modalities, descriptions, rows, rng)
+  return fileName
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description="Write a synthetic in/ and out/ workload for analyze_in_out.py")
+  parser.add_argument("root", help="directory to create the workload in")
+  parser.add_argument("--rows", type=int, default=1_000_000, help="input rows, e.g. 10000 to 100000000")
+  parser.add_argument("--mapping-rows", type=int, default=None,
+                      help="grow the mapping table to this many rows with synthetic descriptions, e.g. 100000")
+  parser.add_argument("--unmapped", type=int, default=None,
+                      help="distinct unmapped descriptions (default: a quarter of the mapping table, or 2%% of the rows)")
+  parser.add_argument("--variants", type=int, default=4, help="spellings per description, the first one clean")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--source", default=REPOSITORY_ROOT,
+                      help="repository root whose out/ tables are used as the base (default: this repository)")
+  args = parser.parse_args(argv)
+
+  fileName = generate(args.root, args.rows, args.mapping_rows, args.unmapped, args.variants, args.seed, args.source)
+  print(f"{args.rows} rows written to {fileName}")
+
+if __name__ == "__main__":
+  main()
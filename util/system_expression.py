@@ -0,0 +1,143 @@
+from collections import namedtuple
+from functools import lru_cache
+
+# Parser for the compound values of the LOINC attributes for filtering, e.g.
+#
+#   Chest+Abdomen+Pelvis
+#   Chest>Heart+Coronary arteries
+#   Neck>Spine.cervical & Chest>Spine.thoracic & Abdomen>Spine.lumbar
+#   Chest+Abdomen+Pelvis && Chest>Aorta.thoracic & Abdomen>Aorta.abdominal
+#
+# Operators, from loosest to tightest binding:
+#
+#   &&   two descriptors of the same study    Both
+#   &    parts of one descriptor              Conjunction
+#   >    region > sub-region                  Region
+#   +    combined regions or sub-regions      Combination
+#
+# Operands of &&, & and + are sorted and deduplicated, so equivalent spellings give equal trees,
+# and every distinct tree is interned: parsing the same value twice returns the same object.
+
+# tree nodes are tuples that only compare equal to nodes of the same type, so that
+# Combination(parts) and Both(parts) stay distinct
+def _node(name, fields):
+  base = namedtuple(name, fields)
+  return type(name, (base,), {
+    "__slots__": (),
+    "__eq__": lambda self, other: type(self) is type(other) and tuple.__eq__(self, other),
+    "__ne__": lambda self, other: not (type(self) is type(other) and tuple.__eq__(self, other)),
+    "__hash__": lambda self: hash((name, tuple(self))),
+  })
+
+Term = _node("Term", ["name"])
+Combination = _node("Combination", ["parts"])
+Region = _node("Region", ["region", "subregion"])
+Conjunction = _node("Conjunction", ["parts"])
+Both = _node("Both", ["parts"])
+
+# values standing for "no system"
+PLACEHOLDERS = {"", "XXX"}
+
+_interned = {}
+
+def intern_tree(node):
+  return _interned.setdefault(node, node)
+
+def _nary(cls, parts):
+  parts = tuple(sorted(set(parts), key=repr))
+  return parts[0] if len(parts) == 1 else intern_tree(cls(parts))
+
+def _parse(text):
+  if "&&" in text:
+    return _nary(Both, (_parse(p) for p in text.split("&&")))
+  if "&" in text:
+    return _nary(Conjunction, (_parse(p) for p in text.split("&")))
+  if ">" in text:
+    region, _, subregion = text.partition(">")
+    return intern_tree(Region(_parse(region), _parse(subregion)))
+  if "+" in text:
+    return _nary(Combination, (_parse(p) for p in text.split("+")))
+  return intern_tree(Term(" ".join(text.split())))
+
+# tree of one attribute value, None for missing or placeholder values
+@lru_cache(maxsize=None)
+def parse_expression(value):
+  if not isinstance(value, str) or " ".join(value.split()) in PLACEHOLDERS:
+    return None
+  return _parse(value.strip())
+
+def _names(name):
+  # a dotted name such as Spine.cervical also stands for its parent Spine
+  names = set()
+  while name:
+    names.add(name)
+    name = name.rpartition(".")[0]
+  return names
+
+# every name in the tree
+def terms(node):
+  if node is None:
+    return frozenset()
+  if isinstance(node, Term):
+    return frozenset(_names(node.name))
+  if isinstance(node, Region):
+    return terms(node.region) | terms(node.subregion)
+  return frozenset().union(*(terms(p) for p in node.parts))
+
+# body regions: every name that is not on the right of a >
+def regions(node):
+  if node is None:
+    return frozenset()
+  if isinstance(node, Term):
+    return frozenset(_names(node.name))
+  if isinstance(node, Region):
+    return regions(node.region)
+  return frozenset().union(*(regions(p) for p in node.parts))
+
+# sub-regions: the names on the right of a >
+def subregions(node):
+  if node is None:
+    return frozenset()
+  if isinstance(node, Term):
+    return frozenset()
+  if isinstance(node, Region):
+    return terms(node.subregion)
+  return frozenset().union(*(subregions(p) for p in node.parts))
+
+# back to the canonical text of a tree
+def format_expression(node):
+  if node is None:
+    return ""
+  if isinstance(node, Term):
+    return node.name
+  if isinstance(node, Region):
+    return f"{format_expression(node.region)}>{format_expression(node.subregion)}"
+  separator = {Both: " && ", Conjunction: " & ", Combination: "+"}[type(node)]
+  return separator.join(format_expression(p) for p in node.parts)
+
+# flattened regions and sub-regions of every LOINC code for one attribute column, with the
+# inverse maps, so region queries are set lookups
+class RegionIndex:
+
+  def __init__(self, attributes, column="MIDRC-System"):
+    self.column = column
+    self.trees = {}
+    self.regions = {}
+    self.subregions = {}
+    self.codesByRegion = {}
+    self.codesBySubregion = {}
+    for code, value in zip(attributes["LOINC code"], attributes[column]):
+      tree = parse_expression(value)
+      self.trees[code] = tree
+      self.regions[code] = regions(tree)
+      self.subregions[code] = subregions(tree)
+      for region in self.regions[code]:
+        self.codesByRegion.setdefault(region, set()).add(code)
+      for subregion in self.subregions[code]:
+        self.codesBySubregion.setdefault(subregion, set()).add(code)
+
+  def codes_with_region(self, region):
+    return frozenset(self.codesByRegion.get(region, ()))
+
+  def codes_with_subregion(self, subregion):
+    return frozenset(self.codesBySubregion.get(subregion, ()))